@@ -0,0 +1,83 @@
+import io
+import json
+import socket
+import threading
+import time
+from kachery_client._misc import _JsonFrameDecoder
+
+# Compare the buffered _JsonFrameDecoder against the previous parser, which
+# read the <size>#<json> length prefix one byte at a time from the response.
+# The stream is sent over a local socket and read without buffering so that,
+# as with the HTTP response, each read is a system call.
+
+def _make_stream(num_messages: int) -> bytes:
+    parts = []
+    for ii in range(num_messages):
+        msg = json.dumps({'type': 'progress', 'bytesLoaded': ii * 1000, 'bytesTotal': num_messages * 1000}).encode()
+        parts.append(f'{len(msg)}#'.encode() + msg)
+    msg = json.dumps({'type': 'finished', 'localFilePath': '/some/path'}).encode()
+    parts.append(f'{len(msg)}#'.encode() + msg)
+    return b''.join(parts)
+
+def _parse_bytewise(raw: io.RawIOBase):
+    # the previous implementation
+    messages = []
+    while True:
+        buf = bytearray(b'')
+        while True:
+            c = raw.read(1)
+            if len(c) == 0:
+                return messages
+            if c == b'#':
+                size = int(buf)
+                x = _read_exactly(raw, size)
+                messages.append(json.loads(x))
+                break
+            else:
+                buf.append(c[0])
+
+def _read_exactly(raw: io.RawIOBase, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        data = raw.read(size - len(buf))
+        if len(data) == 0:
+            break
+        buf.extend(data)
+    return bytes(buf)
+
+def _open_stream(stream: bytes) -> io.RawIOBase:
+    sock_read, sock_write = socket.socketpair()
+    def send():
+        sock_write.sendall(stream)
+        sock_write.close()
+    threading.Thread(target=send, daemon=True).start()
+    return sock_read.makefile('rb', buffering=0)
+
+def _parse_buffered(raw: io.RawIOBase, block_size: int):
+    messages = []
+    decoder = _JsonFrameDecoder()
+    while True:
+        data = raw.read(block_size)
+        if len(data) == 0:
+            return messages
+        messages.extend(decoder.feed(data))
+
+def main():
+    num_messages = 200000
+    stream = _make_stream(num_messages)
+    print(f'Stream of {num_messages + 1} messages ({len(stream)} bytes)')
+
+    timer = time.time()
+    a = _parse_bytewise(_open_stream(stream))
+    elapsed = time.time() - timer
+    print(f'byte-at-a-time: {len(a) / elapsed:.0f} messages/sec')
+
+    for block_size in [512, 4096, 65536]:
+        timer = time.time()
+        b = _parse_buffered(_open_stream(stream), block_size)
+        elapsed = time.time() - timer
+        assert b == a
+        print(f'buffered (block size {block_size}): {len(b) / elapsed:.0f} messages/sec')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import kachery_client as kc
+from kachery_client._daemon_connection import _connected_to_daemon, _kachery_storage_dir
+from kachery_client._local_kachery_storage import _get_path_ext, _compute_file_hash
+
+# Per-call latency of load_file, load_bytes and load_npy for files that are
+# already in the local kachery storage, with and without the daemon.
+#
+# Usage: python benchmark_offline_load.py [num-calls]
+# Offline mode is always measured using a temporary storage directory. If a
+# daemon is running, the same files are also loaded through the daemon's
+# storage directory in normal mode and in offline mode.
+
+def _add_to_storage(storage_dir: str, path: str) -> str:
+    sha1 = _compute_file_hash(path, algorithm='sha1')
+    path0 = _get_path_ext(hash=sha1, create=True, directory=f'{storage_dir}/sha1')
+    if not os.path.exists(path0):
+        with open(path, 'rb') as f1, open(path0, 'wb') as f2:
+            f2.write(f1.read())
+    return f'sha1://{sha1}/{os.path.basename(path)}'
+
+def _create_test_files(tmpdir: str, store):
+    npy_path = f'{tmpdir}/x.npy'
+    np.save(npy_path, np.arange(1000, dtype=np.float32))
+    dat_path = f'{tmpdir}/x.dat'
+    with open(dat_path, 'wb') as f:
+        f.write(os.urandom(100000))
+    return store(npy_path), store(dat_path)
+
+def _time_per_call(func, num_calls: int) -> float:
+    func() # warm up
+    timer = time.time()
+    for _ in range(num_calls):
+        func()
+    return (time.time() - timer) / num_calls
+
+def _run(label: str, npy_uri: str, dat_uri: str, num_calls: int):
+    assert kc.load_file(dat_uri) is not None
+    results = [
+        ('load_file', _time_per_call(lambda: kc.load_file(dat_uri), num_calls)),
+        ('load_bytes', _time_per_call(lambda: kc.load_bytes(dat_uri, start=1000, end=2000), num_calls)),
+        ('load_npy', _time_per_call(lambda: kc.load_npy(npy_uri), num_calls))
+    ]
+    for name, t in results:
+        print(f'{label}: {name}: {t * 1e6:.1f} usec/call')
+
+def main():
+    num_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage_dir = f'{tmpdir}/storage'
+        os.mkdir(storage_dir)
+        npy_uri, dat_uri = _create_test_files(tmpdir, lambda path: _add_to_storage(storage_dir, path))
+        kc.set_offline_storage_dir(storage_dir)
+        _run('offline', npy_uri, dat_uri, num_calls)
+        kc.set_offline_storage_dir(None)
+
+        if _connected_to_daemon():
+            daemon_storage_dir = _kachery_storage_dir()
+            npy_uri, dat_uri = _create_test_files(tmpdir, kc.store_file)
+            _run('daemon', npy_uri, dat_uri, num_calls)
+            kc.set_offline_storage_dir(daemon_storage_dir)
+            _run('offline (daemon storage dir)', npy_uri, dat_uri, num_calls)
+            kc.set_offline_storage_dir(None)
+        else:
+            print('Not connected to a daemon. Skipping daemon measurements.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import hashlib
+from kachery_client._local_kachery_storage import _compute_local_file_sha1_and_manifest
+from kachery_client import _file_hash_cache
+
+# Compare the throughput of the pipelined _compute_local_file_sha1_and_manifest
+# against the previous serial implementation.
+#
+# Usage: python benchmark_sha1_manifest.py [path-or-size-in-GB]
+# If a size is given (default 10), a file of that size is generated in the
+# current directory and removed afterwards. Note that the results depend on
+# whether the file is in the page cache, so each method is run twice. The
+# persistent file hash cache is disabled, so that the pipelined method
+# actually hashes the file each time (and the user's cache is not modified).
+
+def _compute_sha1_and_manifest_serial(path):
+    # the previous implementation
+    manifest = {
+        'size': 0,
+        'sha1': '',
+        'chunks': []
+    }
+    size0 = os.path.getsize(path)
+    chunk_size = 20000000
+    hashsum = hashlib.sha1()
+    with open(path, 'rb') as file:
+        pos = 0
+        while pos < size0:
+            this_chunk_size = min(chunk_size, size0 - pos)
+            this_chunk_hashsum = hashlib.sha1()
+            buf = file.read(this_chunk_size)
+            this_chunk_hashsum.update(buf)
+            hashsum.update(buf)
+            manifest['chunks'].append({
+                'start': pos,
+                'end': pos + this_chunk_size,
+                'sha1': this_chunk_hashsum.hexdigest()
+            })
+            pos = pos + this_chunk_size
+    sha1 = hashsum.hexdigest()
+    manifest['sha1'] = sha1
+    manifest['size'] = size0
+    return sha1, manifest
+
+def _generate_file(path: str, size: int):
+    block = os.urandom(64 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        num_written = 0
+        while num_written < size:
+            n = min(len(block), size - num_written)
+            f.write(block[:n])
+            num_written += n
+
+def main():
+    _file_hash_cache._global['disabled'] = True
+    arg = sys.argv[1] if len(sys.argv) > 1 else '10'
+    if os.path.exists(arg):
+        path = arg
+        generated = False
+    else:
+        path = 'benchmark_sha1_manifest.dat'
+        size = int(float(arg) * 1e9)
+        print(f'Generating file of {size} bytes: {path}')
+        _generate_file(path, size)
+        generated = True
+    try:
+        size = os.path.getsize(path)
+        results = {}
+        for label, func in [('serial', _compute_sha1_and_manifest_serial), ('pipelined', _compute_local_file_sha1_and_manifest)] * 2:
+            timer = time.time()
+            results[label] = func(path)
+            elapsed = time.time() - timer
+            print(f'{label}: {elapsed:.2f} sec ({size / elapsed / 1e6:.0f} MB/sec)')
+        assert results['serial'] == results['pipelined']
+    finally:
+        if generated:
+            os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import shutil
+import stat
+from kachery_client._local_kachery_storage import _copy_file_into_storage
+
+# Compare the methods used by _copy_file_into_storage to put a file into the
+# kachery storage: the time taken and the additional disk space used.
+#
+# Usage: python benchmark_store_strategy.py [size-in-GB] [directory]
+# A file of the given size (default 2) is generated in the directory (default:
+# current directory, which should be on the same file system as the kachery
+# storage to be representative) and removed afterwards. The source file is
+# made read-only so that the hardlink method can be used.
+
+def _generate_file(path: str, size: int):
+    block = os.urandom(64 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        num_written = 0
+        while num_written < size:
+            n = min(len(block), size - num_written)
+            f.write(block[:n])
+            num_written += n
+
+def _disk_used(directory: str) -> int:
+    s = os.statvfs(directory)
+    return (s.f_blocks - s.f_bfree) * s.f_frsize
+
+def main():
+    size = int(float(sys.argv[1] if len(sys.argv) > 1 else '2') * 1e9)
+    directory = os.path.abspath(sys.argv[2] if len(sys.argv) > 2 else '.')
+    workdir = f'{directory}/benchmark_store_strategy'
+    os.mkdir(workdir)
+    try:
+        src = f'{workdir}/source.dat'
+        print(f'Generating file of {size} bytes: {src}')
+        _generate_file(src, size)
+        os.chmod(src, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        for strategy in ['copy', 'copy_file_range', 'hardlink', 'reflink', 'auto']:
+            dest = f'{workdir}/{strategy}.dat'
+            os.sync()
+            disk_used_before = _disk_used(workdir)
+            timer = time.time()
+            mode = _copy_file_into_storage(src, dest, strategy=strategy)
+            os.sync()
+            elapsed = time.time() - timer
+            additional_disk_used = _disk_used(workdir) - disk_used_before
+            print(f'{strategy}: used {mode}: {elapsed:.2f} sec ({size / elapsed / 1e6:.0f} MB/sec), additional disk used: {additional_disk_used / 1e6:.0f} MB')
+            os.unlink(dest)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
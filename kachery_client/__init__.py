@@ -1,10 +1,12 @@
 from .version import __version__
-from .main import load_bytes, load_feed, load_file, load_json, load_npy, load_pkl, load_subfeed, load_text
+from .main import load_bytes, load_buffer, load_feed, load_file, load_files, load_json, load_npy, load_pkl, load_subfeed, load_text
 from .main import create_feed
-from .main import store_file, store_json, store_npy, store_pkl, store_text, link_file
+from .main import store_file, store_files, store_json, store_npy, store_pkl, store_text, link_file, find_stale_links
 from .main import get, set, delete, get_feed_id, get_string
 from .main import watch_for_new_messages
 from .main import parse_uri, build_uri
+from .main import set_offline_storage_dir
+from .main import gc_ephemeral_storage, pin_file, unpin_file
 
 from .request_task import request_task
 from .task_backend.taskfunction import taskfunction
@@ -15,13 +17,16 @@ from ._daemon_connection import _kachery_storage_dir, _kachery_temp_dir
 from ._temporarydirectory import TemporaryDirectory
 from ._shellscript import ShellScript
 
-from ._feeds import Feed, Subfeed
+from ._feeds import Feed, Subfeed, SubfeedWriter
+from ._feed_watcher import FeedWatcher, SubfeedWatch
 
 from .upload_file import upload_file, upload_text, upload_json, upload_npy, upload_pkl
 
 from .ephemeral_client_deprecated.EphemeralClient import EphemeralClient
 from .direct_client.DirectClient import DirectClient
 from .enable_ephemeral import enable_ephemeral
+from .load_cache import enable_load_cache, get_load_cache_stats, clear_load_cache
+from .local_storage_index import enable_local_storage_index, clear_local_storage_index
 from .ephemeral.config_ephemeral_node import config_ephemeral_node
 
 from .setup_colab_ephemeral import setup_colab_ephemeral
\ No newline at end of file
@@ -1,7 +1,8 @@
 import os
 import time
 import tempfile
-from typing import List, Union, cast
+import threading
+from typing import Callable, Dict, List, Union, cast
 from ._misc import _http_get_json
 
 def _daemon_port():
@@ -78,18 +79,151 @@ class _probe_result:
                 raise Exception(f'Inconsistent node ID between running daemon and kachery storage directory: {node_id_from_file} <> {self.node_id} ({fname})')
         self.kachery_storage_dir = ksd
 
-class _buffered_probe_data:
-    timestamp: float=0
-    result: Union[None, _probe_result]=None
+def _daemon_probe_ttl() -> float:
+    # how long a successful probe result is used before it is refreshed
+    return float(os.getenv('KACHERY_DAEMON_PROBE_TTL', 10))
+
+def _daemon_probe_max_backoff() -> float:
+    # the maximum interval between probes while the daemon is not reachable
+    return float(os.getenv('KACHERY_DAEMON_PROBE_MAX_BACKOFF', 30))
+
+_DAEMON_PROBE_INITIAL_BACKOFF = 1
+
+class _ProbeManager:
+    """Keeps the result of probing the daemon up to date
+
+    The first call probes the daemon synchronously. After that the probe is
+    refreshed by a background thread (after the TTL on success, or with
+    exponential backoff on failure), so callers get the most recent result
+    without waiting. The thread exits when the result has not been requested
+    for a while, and is restarted on the next request.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._probed = False
+        self._result: Union[None, _probe_result] = None
+        self._exception: Union[None, Exception] = None
+        self._num_failures = 0
+        self._next_probe_time: float = 0
+        self._last_access_time: float = 0
+        self._thread: Union[None, threading.Thread] = None
+        self._thread_pid: Union[None, int] = None
+        self._listeners: List[Callable[[Union[None, _probe_result]], None]] = []
+    def get(self) -> Union[None, _probe_result]:
+        now = time.monotonic()
+        with self._lock:
+            self._last_access_time = now
+            up_to_date = self._probed and ((now < self._next_probe_time) or self._background_refresh_running())
+        if not up_to_date:
+            with self._probe_lock:
+                # another thread may have probed while we were waiting
+                with self._lock:
+                    up_to_date = self._probed and (time.monotonic() < self._next_probe_time)
+                if not up_to_date:
+                    self._probe_and_update()
+        self._start_background_refresh_if_needed()
+        with self._lock:
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+    def refresh(self) -> None:
+        # probe again now, for example after the daemon was restarted
+        with self._probe_lock:
+            self._probe_and_update()
+        # the background thread may be waiting on an earlier (backoff) deadline
+        self._wake.set()
+    def add_listener(self, listener: Callable[[Union[None, _probe_result]], None]) -> None:
+        with self._lock:
+            self._listeners.append(listener)
+    def remove_listener(self, listener: Callable[[Union[None, _probe_result]], None]) -> None:
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+    def _probe_and_update(self) -> None:
+        result: Union[None, _probe_result] = None
+        exception: Union[None, Exception] = None
+        try:
+            result = _probe_daemon()
+        except Exception as e:
+            # for example, inconsistent node ID between daemon and storage directory
+            exception = e
+        with self._lock:
+            previous = self._result if self._probed else _not_probed
+            self._probed = True
+            self._result = result
+            self._exception = exception
+            if result is not None:
+                self._num_failures = 0
+                delay = _daemon_probe_ttl()
+            else:
+                self._num_failures += 1
+                delay = min(_DAEMON_PROBE_INITIAL_BACKOFF * 2 ** (self._num_failures - 1), _daemon_probe_max_backoff())
+            self._next_probe_time = time.monotonic() + delay
+            listeners = list(self._listeners)
+        if previous is not _not_probed and _probe_status_changed(previous, result):
+            for listener in listeners:
+                try:
+                    listener(result)
+                except Exception as e:
+                    print(f'WARNING: problem in daemon status listener: {str(e)}')
+    def _background_refresh_running(self) -> bool:
+        return (self._thread is not None) and (self._thread_pid == os.getpid()) and self._thread.is_alive()
+    def _start_background_refresh_if_needed(self) -> None:
+        with self._lock:
+            if self._background_refresh_running():
+                return
+            # the thread does not survive a fork, so we also check the pid
+            self._thread = threading.Thread(target=self._background_refresh, daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+    def _background_refresh(self) -> None:
+        while True:
+            with self._lock:
+                self._wake.clear()
+                delay = self._next_probe_time - time.monotonic()
+                idle_time = time.monotonic() - self._last_access_time
+                if idle_time > max(60, 10 * _daemon_probe_ttl()):
+                    # nobody has asked for a while; the next request will probe synchronously
+                    self._thread = None
+                    return
+            if delay > 0:
+                self._wake.wait(timeout=delay)
+                continue
+            with self._probe_lock:
+                self._probe_and_update()
+
+_not_probed = object()
+
+def _probe_status_changed(a: Union[None, _probe_result], b: Union[None, _probe_result]):
+    if (a is None) or (b is None):
+        return (a is None) != (b is None)
+    return a.node_id != b.node_id
+
+_probe_manager = _ProbeManager()
 
 def _buffered_probe_daemon(daemon_port=None):
-    elapsed_since_last = time.time() - _buffered_probe_data.timestamp
-    if elapsed_since_last <= 10:
-        return _buffered_probe_data.result
-    res = _probe_daemon(daemon_port=daemon_port)
-    _buffered_probe_data.timestamp = time.time()
-    _buffered_probe_data.result = res
-    return _buffered_probe_data.result
+    if _offline_mode():
+        # there is no daemon in offline mode
+        return None
+    if (daemon_port is not None) and (str(daemon_port) != str(_daemon_port())):
+        # only the default daemon is tracked by the probe manager
+        return _probe_daemon(daemon_port=daemon_port)
+    return _probe_manager.get()
+
+def _refresh_daemon_probe():
+    _probe_manager.refresh()
+
+def _add_daemon_status_listener(listener: Callable[[Union[None, _probe_result]], None]):
+    """The listener is called with the new probe result (None if the daemon is not reachable) when the daemon appears, disappears or is replaced"""
+    _probe_manager.add_listener(listener)
+
+def _remove_daemon_status_listener(listener: Callable[[Union[None, _probe_result]], None]):
+    _probe_manager.remove_listener(listener)
+
+# the client auth code is regenerated when the daemon restarts
+_add_daemon_status_listener(lambda result: _reset_client_auth_code())
 
 def _probe_daemon(daemon_port=None):
     daemon_url, headers = _daemon_url(daemon_port=daemon_port, no_client_auth=True)
@@ -101,12 +235,33 @@ def _probe_daemon(daemon_port=None):
     res = _probe_result(x) if x is not None else None
     return res
 
-def _kachery_offline_storage_dir_env_is_set():
-    return os.getenv('KACHERY_OFFLINE_STORAGE_DIR', None) is not None
+# In offline mode the kachery storage directory is configured once (either
+# with _set_kachery_offline_storage_dir() or the KACHERY_OFFLINE_STORAGE_DIR
+# env variable) and files are resolved from the filesystem only, without
+# probing or contacting the daemon.
+_offline_config: Dict[str, Union[str, None]] = {
+    'storage_dir': None
+}
+
+def _set_kachery_offline_storage_dir(storage_dir: Union[str, None]):
+    if storage_dir is not None:
+        storage_dir = os.path.abspath(storage_dir)
+        if not os.path.isdir(storage_dir):
+            raise Exception(f'Kachery storage directory does not exist: {storage_dir}')
+    _offline_config['storage_dir'] = storage_dir
+
+def _kachery_offline_storage_dir() -> Union[str, None]:
+    if _offline_config['storage_dir'] is not None:
+        return _offline_config['storage_dir']
+    return os.getenv('KACHERY_OFFLINE_STORAGE_DIR', None)
+
+def _offline_mode() -> bool:
+    return _kachery_offline_storage_dir() is not None
 
 def _kachery_storage_dir():
-    if _kachery_offline_storage_dir_env_is_set():
-        return os.getenv('KACHERY_OFFLINE_STORAGE_DIR', None)
+    offline_storage_dir = _kachery_offline_storage_dir()
+    if offline_storage_dir is not None:
+        return offline_storage_dir
     else:
         p = _buffered_probe_daemon()
         if p is not None:
@@ -128,8 +283,9 @@ def _kachery_temp_dir() -> str:
     d = os.getenv('KACHERY_TEMP_DIR', None)
     if d is not None:
         return _create_if_needed(d)
-    if _kachery_offline_storage_dir_env_is_set():
-        return _create_if_needed(os.getenv('KACHERY_OFFLINE_STORAGE_DIR', '') + '/kachery-tmp')
+    offline_storage_dir = _kachery_offline_storage_dir()
+    if offline_storage_dir is not None:
+        return _create_if_needed(offline_storage_dir + '/kachery-tmp')
     else:
         return _create_if_needed(tempfile.gettempdir() + '/kachery-tmp')
 
@@ -0,0 +1,201 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Dict, List, Tuple, Union
+
+# Keeps the ephemeral kachery storage directory (used by DirectClient and in
+# ephemeral mode, i.e., when there is no daemon) under a maximum size.
+#
+# An sqlite index in the storage directory records, for each file that was
+# added to the storage by kachery_client (downloaded or stored), its size,
+# last access time and access count. Only those files are ever evicted: files
+# that were already on disk (e.g., stored by a daemon) are never indexed. When
+# the storage exceeds KACHERY_EPHEMERAL_STORAGE_QUOTA_GB (if set), or when gc
+# is run explicitly, indexed files that are not pinned are evicted in
+# least-recently-used (or least-frequently-used) order. The manager never
+# operates on a directory that belongs to a kachery daemon.
+#
+# Eviction is safe while other processes are reading: files are only ever
+# written under temporary names and renamed into place, so only complete
+# files are evicted; a file that is open remains readable after it is
+# removed; and files accessed within the last _EVICTION_GRACE_PERIOD_SEC are
+# not evicted, so that a path that was just returned by load_file can still
+# be opened.
+
+_EVICTION_GRACE_PERIOD_SEC = 600
+
+# access times are recorded at most this often for a given file
+_ACCESS_RECORD_INTERVAL_SEC = 60
+
+# entries for files that were removed by other means are dropped at least
+# this often when the index is used for eviction
+_INDEX_SYNC_INTERVAL_SEC = 24 * 3600
+
+_EVICTION_POLICIES = ['lru', 'lfu']
+
+def _get_ephemeral_kachery_storage_dir():
+    from pathlib import Path
+    homedir = str(Path.home())
+    ksd = os.getenv('KACHERY_STORAGE_DIR', f'{homedir}/kachery-storage')
+    if not os.path.exists(ksd):
+        os.makedirs(ksd)
+    return ksd
+
+def _is_daemon_storage_dir(ksd: str) -> bool:
+    return os.path.exists(f'{ksd}/kachery-node-id') or os.path.exists(f'{ksd}/client-auth')
+
+def _ephemeral_storage_quota() -> Union[int, None]:
+    x = os.getenv('KACHERY_EPHEMERAL_STORAGE_QUOTA_GB', None)
+    if x is None:
+        return None
+    return int(float(x) * 1e9)
+
+def _ephemeral_storage_eviction_policy() -> str:
+    policy = os.getenv('KACHERY_EPHEMERAL_STORAGE_EVICTION_POLICY', 'lru')
+    if policy not in _EVICTION_POLICIES:
+        raise Exception(f'Invalid KACHERY_EPHEMERAL_STORAGE_EVICTION_POLICY: {policy} (expected lru or lfu)')
+    return policy
+
+def _connect() -> sqlite3.Connection:
+    ksd = _get_ephemeral_kachery_storage_dir()
+    if _is_daemon_storage_dir(ksd):
+        raise Exception(f'Not managing the ephemeral storage because it is the storage directory of a kachery daemon: {ksd}')
+    db_path = f'{ksd}/ephemeral-storage-index.db'
+    # timeout: wait for other processes that are writing to the database
+    conn = sqlite3.connect(db_path, timeout=30)
+    # files that were added by kachery_client (the only ones that are evicted)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            sha1 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL,
+            access_count INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pins (
+            sha1 TEXT PRIMARY KEY
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value REAL NOT NULL
+        )
+    ''')
+    return conn
+
+def _file_path(sha1: str) -> str:
+    return f'{_get_ephemeral_kachery_storage_dir()}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
+
+_last_recorded_access: Dict[str, float] = {}
+_last_recorded_access_lock = threading.Lock()
+
+def _record_ephemeral_storage_access(sha1: str, *, added: bool=False) -> None:
+    """Record that a file in the ephemeral storage was accessed, or added by kachery_client (in which case the quota is enforced)"""
+    if _is_daemon_storage_dir(_get_ephemeral_kachery_storage_dir()):
+        return
+    now = time.time()
+    if not added:
+        with _last_recorded_access_lock:
+            if now - _last_recorded_access.get(sha1, 0) < _ACCESS_RECORD_INTERVAL_SEC:
+                return
+            _last_recorded_access[sha1] = now
+    try:
+        with closing(_connect()) as conn, conn:
+            if added:
+                size = os.stat(_file_path(sha1)).st_size
+                conn.execute('''
+                    INSERT INTO files (sha1, size, last_access, access_count) VALUES (?, ?, ?, 1)
+                    ON CONFLICT(sha1) DO UPDATE SET size = excluded.size, last_access = excluded.last_access, access_count = access_count + 1
+                ''', (sha1, size, now))
+            else:
+                # files that were not added by kachery_client are not indexed
+                conn.execute('UPDATE files SET last_access = ?, access_count = access_count + 1 WHERE sha1 = ?', (now, sha1))
+        if added:
+            quota = _ephemeral_storage_quota()
+            if quota is not None:
+                _enforce_quota(quota)
+    except (OSError, sqlite3.Error) as e:
+        print(f'WARNING: problem updating ephemeral storage index: {str(e)}')
+
+def _enforce_quota(quota: int) -> None:
+    with closing(_connect()) as conn, conn:
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', ('last_sync',)).fetchone()
+        if row is None or time.time() - row[0] > _INDEX_SYNC_INTERVAL_SEC:
+            _sync_index(conn)
+        total_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+    if total_size > quota:
+        # evict a little more than needed so that we don't need to evict on every addition
+        _gc_ephemeral_storage(max_bytes=int(quota * 0.9), sync=False)
+
+def _sync_index(conn: sqlite3.Connection) -> None:
+    # remove entries for files that no longer exist (files on disk that are not
+    # in the index are never added, since they were not added by kachery_client)
+    indexed = [row[0] for row in conn.execute('SELECT sha1 FROM files')]
+    conn.executemany('DELETE FROM files WHERE sha1 = ?', [(sha1,) for sha1 in indexed if not os.path.exists(_file_path(sha1))])
+    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('last_sync', time.time()))
+
+def _gc_ephemeral_storage(*, max_bytes: Union[int, None]=None, policy: Union[str, None]=None, dry_run: bool=False, sync: bool=True) -> dict:
+    """Evict unpinned files that were added by kachery_client from the ephemeral storage until the total size of those files is at most max_bytes (defaults to the quota)"""
+    if max_bytes is None:
+        max_bytes = _ephemeral_storage_quota()
+        if max_bytes is None:
+            raise Exception('No maximum size given and KACHERY_EPHEMERAL_STORAGE_QUOTA_GB is not set.')
+    if policy is None:
+        policy = _ephemeral_storage_eviction_policy()
+    if policy not in _EVICTION_POLICIES:
+        raise Exception(f'Invalid eviction policy: {policy} (expected lru or lfu)')
+    order_by = 'last_access ASC' if policy == 'lru' else 'access_count ASC, last_access ASC'
+    not_pinned = 'NOT EXISTS (SELECT 1 FROM pins WHERE pins.sha1 = files.sha1)'
+    with closing(_connect()) as conn:
+        with conn:
+            if sync:
+                _sync_index(conn)
+            total_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+            candidates: List[Tuple[str, int]] = conn.execute(
+                f'SELECT sha1, size FROM files WHERE {not_pinned} AND last_access < ? ORDER BY {order_by}',
+                (time.time() - _EVICTION_GRACE_PERIOD_SEC,)
+            ).fetchall()
+        num_bytes = total_size
+        evicted: List[str] = []
+        for sha1, size in candidates:
+            if num_bytes <= max_bytes:
+                break
+            if not dry_run:
+                with conn:
+                    # deleting the entry first locks the index, so that the file
+                    # cannot be accessed or pinned by another process before it
+                    # is removed (the condition is checked again since the
+                    # candidates were listed)
+                    cursor = conn.execute(
+                        f'DELETE FROM files WHERE sha1 = ? AND {not_pinned} AND last_access < ?',
+                        (sha1, time.time() - _EVICTION_GRACE_PERIOD_SEC)
+                    )
+                    if cursor.rowcount == 0:
+                        continue
+                    try:
+                        os.unlink(_file_path(sha1))
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        # e.g., on Windows, a file that is open cannot be removed
+                        print(f'WARNING: unable to evict file from ephemeral storage: {sha1}: {str(e)}')
+                        conn.rollback()
+                        continue
+            evicted.append(sha1)
+            num_bytes -= size
+    return {
+        'num_files_evicted': len(evicted),
+        'num_bytes_evicted': total_size - num_bytes,
+        'num_bytes_remaining': num_bytes
+    }
+
+def _set_ephemeral_storage_pinned(sha1: str, pinned: bool) -> None:
+    with closing(_connect()) as conn, conn:
+        if pinned:
+            conn.execute('INSERT OR IGNORE INTO pins (sha1) VALUES (?)', (sha1,))
+        else:
+            conn.execute('DELETE FROM pins WHERE sha1 = ?', (sha1,))
@@ -0,0 +1,168 @@
+import bisect
+import struct
+import threading
+from collections import OrderedDict
+from typing import Any, List, Union
+
+import simplejson
+
+from ._load_file import _load_bytes, _load_json
+from ._store_file import _store_bytes
+
+# Feed snapshots are stored in chunks: for each subfeed, the messages are
+# split into segments of (at most) segmentSize messages, each stored as a
+# separate sha1:// object, and the snapshot itself (feed.json) is a small
+# index of the segments:
+#
+#     {'feedId': ..., 'subfeeds': {<subfeed hash>: {
+#         'subfeedHash': ..., 'numMessages': ..., 'segmentSize': ...,
+#         'segments': [{'uri': 'sha1://...', 'offsetsUri': 'sha1://...', 'numMessages': ...}, ...]
+#     }}}
+#
+# A segment is a newline-delimited JSON file (one message per line), and its
+# offsets object holds the byte offsets of the numMessages + 1 line
+# boundaries as little-endian uint64. A range of messages is read by loading
+# the corresponding slice of the offsets and then the slice of the messages
+# (using _load_bytes), so reading a few messages costs a few kilobytes
+# regardless of the size of the subfeed.
+#
+# Since subfeeds are append-only, the full segments of a previous snapshot
+# can be reused when creating a new snapshot of the same subfeed, so only the
+# new messages need to be read and stored. Older snapshots, with segments
+# stored as JSON lists (no offsetsUri) or with the messages stored directly in
+# the index ('messages'), can still be read.
+#
+# Unlike the older format, a snapshot is not self-contained in feed.json:
+# segments that are not in the local kachery storage are loaded from the
+# channel given when loading the snapshot (Feed(uri, channel=...)).
+
+_DEFAULT_SNAPSHOT_SEGMENT_SIZE = 10000
+
+# number of loaded JSON list segments kept in memory per subfeed
+_NUM_CACHED_SEGMENTS = 4
+
+_OFFSET_SIZE = 8
+
+class _SnapshotSubfeed:
+    """The messages of a subfeed in a snapshot"""
+    def __init__(self, obj: Union[dict, None], *, channel: Union[str, None]=None):
+        # obj is the entry for the subfeed in the snapshot (None if not present)
+        # channel is used to load segments that are not in the local storage
+        self._channel = channel
+        self._messages: Union[List[Any], None] = None
+        self._segments: List[dict] = []
+        # position of the first message of each segment
+        self._segment_starts: List[int] = []
+        self._num_messages = 0
+        if obj is None:
+            self._messages = []
+        elif 'messages' in obj:
+            self._messages = obj['messages']
+            self._num_messages = len(self._messages)
+        else:
+            position = 0
+            for segment in obj['segments']:
+                self._segments.append(segment)
+                self._segment_starts.append(position)
+                position = position + segment['numMessages']
+            self._num_messages = position
+        self._lock = threading.Lock()
+        self._loaded_segments: 'OrderedDict[int, List[Any]]' = OrderedDict()
+    @property
+    def num_messages(self) -> int:
+        return self._num_messages
+    def get_messages(self, start: int, end: int) -> List[Any]:
+        start = max(0, start)
+        end = min(end, self._num_messages)
+        if start >= end:
+            return []
+        if self._messages is not None:
+            return self._messages[start:end]
+        ret: List[Any] = []
+        i = bisect.bisect_right(self._segment_starts, start) - 1
+        while i < len(self._segments) and self._segment_starts[i] < end:
+            segment_start = self._segment_starts[i]
+            a = max(0, start - segment_start)
+            b = min(end - segment_start, self._segments[i]['numMessages'])
+            if 'offsetsUri' in self._segments[i]:
+                ret.extend(self._read_messages(self._segments[i], a, b))
+            else:
+                ret.extend(self._load_json_segment(i)[a:b])
+            i = i + 1
+        return ret
+    def _read_messages(self, segment: dict, a: int, b: int) -> List[Any]:
+        # read messages [a, b) of a newline-delimited segment
+        x = _load_bytes(segment['offsetsUri'], start=a * _OFFSET_SIZE, end=(b + 1) * _OFFSET_SIZE, channel=self._channel)
+        if x is None:
+            raise Exception(f'Unable to load offsets of snapshot segment: {segment["offsetsUri"]}')
+        offsets = struct.unpack(f'<{b - a + 1}Q', x)
+        data = _load_bytes(segment['uri'], start=offsets[0], end=offsets[-1], channel=self._channel)
+        if data is None:
+            raise Exception(f'Unable to load snapshot segment: {segment["uri"]}')
+        return [
+            simplejson.loads(data[offsets[k] - offsets[0]:offsets[k + 1] - offsets[0]])
+            for k in range(b - a)
+        ]
+    def _load_json_segment(self, i: int) -> List[Any]:
+        with self._lock:
+            if i in self._loaded_segments:
+                self._loaded_segments.move_to_end(i)
+                return self._loaded_segments[i]
+        segment = self._segments[i]
+        messages = _load_json(segment['uri'], channel=self._channel)
+        if messages is None:
+            raise Exception(f'Unable to load snapshot segment: {segment["uri"]}')
+        if len(messages) != segment['numMessages']:
+            raise Exception(f'Unexpected number of messages in snapshot segment: {segment["uri"]}')
+        with self._lock:
+            self._loaded_segments[i] = messages
+            while len(self._loaded_segments) > _NUM_CACHED_SEGMENTS:
+                self._loaded_segments.popitem(last=False)
+        return messages
+
+def _create_snapshot_subfeed(subfeed, *, previous: Union[dict, None], segment_size: int) -> dict:
+    # subfeed is a (non-snapshot) Subfeed, and previous is its entry in a
+    # previous snapshot (or None)
+    segments: List[dict] = []
+    if previous is not None and previous.get('segmentSize', None) == segment_size and 'segments' in previous:
+        for segment in previous['segments']:
+            if segment['numMessages'] != segment_size:
+                # the last (partial) segment is replaced
+                break
+            segments.append(segment)
+        if len(segments) * segment_size > subfeed.get_num_local_messages():
+            # the subfeed has fewer messages than the previous snapshot (e.g.,
+            # the feed was recreated), so its segments are not a prefix of it
+            segments = []
+    position = len(segments) * segment_size
+    subfeed.set_position(position)
+    buffer: List[Any] = []
+    while True:
+        messages = subfeed.get_next_messages(wait_msec=0, max_num_messages=segment_size - len(buffer))
+        if len(messages) == 0:
+            break
+        buffer.extend(messages)
+        if len(buffer) == segment_size:
+            segments.append(_store_segment(buffer))
+            position = position + len(buffer)
+            buffer = []
+    if len(buffer) > 0:
+        segments.append(_store_segment(buffer))
+        position = position + len(buffer)
+    return dict(
+        subfeedHash=subfeed.subfeed_hash,
+        numMessages=position,
+        segmentSize=segment_size,
+        segments=segments
+    )
+
+def _store_segment(messages: List[Any]) -> dict:
+    lines = [(simplejson.dumps(msg, separators=(',', ':'), indent=None, allow_nan=False) + '\n').encode('utf-8') for msg in messages]
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    return {
+        'uri': _store_bytes(b''.join(lines), basename='segment.jsonl'),
+        'offsetsUri': _store_bytes(struct.pack(f'<{len(offsets)}Q', *offsets), basename='segment.offsets'),
+        'numMessages': len(messages)
+    }
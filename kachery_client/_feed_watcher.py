@@ -0,0 +1,178 @@
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Union
+
+from ._feeds import Subfeed, _watch_for_new_messages
+
+# Follows many subfeeds using a single background long-poll loop. Each
+# iteration sends one /feed/watchForNewMessages request for all of the
+# watched subfeeds (at their current positions), so the number of daemon
+# requests does not grow with the number of followers.
+
+_FEED_WATCHER_INITIAL_BACKOFF_SEC = 1
+_FEED_WATCHER_MAX_BACKOFF_SEC = 30
+
+class SubfeedWatch:
+    """A subfeed that is being followed by a FeedWatcher
+
+    Messages are delivered to the callback (if given), or else queued to be
+    retrieved using get_message() or get_messages().
+    """
+    def __init__(self, *, watcher: 'FeedWatcher', key: str, subfeed: Subfeed, callback: Union[Callable[[Any], None], None]):
+        self._watcher = watcher
+        self._key = key
+        self._feed_id = subfeed._feed_id
+        self._subfeed_hash = subfeed.subfeed_hash
+        self._channel = subfeed._channel
+        self._position = subfeed.position
+        self._callback = callback
+        self._queue: 'queue.Queue[Any]' = queue.Queue()
+    @property
+    def position(self) -> int:
+        """The position in the subfeed after the last message that was received"""
+        return self._position
+    def get_message(self, *, timeout: Union[float, None]=None) -> Union[Any, None]:
+        """Return the next received message, waiting up to timeout seconds (forever if None), or None if there is none"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+    def get_messages(self) -> List[Any]:
+        """Return all of the messages that have been received and not yet retrieved, without waiting"""
+        ret = []
+        while True:
+            try:
+                ret.append(self._queue.get_nowait())
+            except queue.Empty:
+                return ret
+    def close(self):
+        """Stop following the subfeed"""
+        self._watcher._remove(self._key)
+    def _watch_dict(self) -> dict:
+        return {
+            'feedId': self._feed_id,
+            'subfeedHash': self._subfeed_hash,
+            'channelName': self._channel,
+            'position': self._position
+        }
+    def _deliver(self, messages: List[Any]):
+        self._position = self._position + len(messages)
+        for msg in messages:
+            if self._callback is not None:
+                try:
+                    self._callback(msg)
+                except Exception as e:
+                    print(f'WARNING: problem in subfeed watch callback: {str(e)}')
+            else:
+                self._queue.put(msg)
+
+class FeedWatcher:
+    """Follow many subfeeds using a single background long-poll loop
+
+    Example:
+        watcher = kc.FeedWatcher()
+        w = watcher.watch(feed.load_subfeed('a'))
+        watcher.watch(feed.load_subfeed('b'), callback=lambda msg: print(msg))
+        msg = w.get_message(timeout=10)
+        ...
+        watcher.stop()
+
+    A subfeed that is added while a poll is in progress is included in the
+    next poll (after at most wait_msec). Callbacks are called from the
+    background thread, in order, and should return quickly.
+    """
+    def __init__(self, *, wait_msec: int=5000, signed: bool=False, max_num_messages: int=0):
+        """
+        Args:
+            wait_msec (int, optional): The duration of each long poll. Defaults to 5000.
+            signed (bool, optional): Whether to retrieve signed messages. Defaults to False.
+            max_num_messages (int, optional): The maximum number of messages retrieved per subfeed and poll (0 for no limit). Defaults to 0.
+        """
+        self._wait_msec = wait_msec
+        self._signed = signed
+        self._max_num_messages = max_num_messages
+        self._lock = threading.Lock()
+        self._watches: Dict[str, SubfeedWatch] = {}
+        self._last_key = 0
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: Union[None, threading.Thread] = None
+        self._last_error: Union[None, Exception] = None
+    def watch(self, subfeed: Subfeed, *, callback: Union[Callable[[Any], None], None]=None) -> SubfeedWatch:
+        """Start following a subfeed from its current position
+
+        Args:
+            subfeed (Subfeed): The subfeed (not a snapshot)
+            callback (Union[Callable[[Any], None], None], optional): Called with each new message. If None, the messages are queued on the returned SubfeedWatch. Defaults to None.
+
+        Returns:
+            SubfeedWatch: The watch, which can be used to retrieve messages and to stop following the subfeed
+        """
+        if subfeed.is_snapshot:
+            raise Exception('Cannot watch a snapshot subfeed')
+        with self._lock:
+            if self._stopped:
+                raise Exception('Cannot watch a subfeed after the feed watcher was stopped')
+            self._last_key = self._last_key + 1
+            key = f'w{self._last_key}'
+            w = SubfeedWatch(watcher=self, key=key, subfeed=subfeed, callback=callback)
+            self._watches[key] = w
+            if (self._thread is None) or (not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return w
+    @property
+    def last_error(self) -> Union[None, Exception]:
+        """The error from the most recent poll, if it failed (polls are retried with backoff)"""
+        return self._last_error
+    def stop(self):
+        """Stop following all subfeeds. An in-progress poll is abandoned."""
+        with self._lock:
+            self._stopped = True
+            self._watches.clear()
+        self._wake.set()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+    def _remove(self, key: str):
+        with self._lock:
+            if key in self._watches:
+                del self._watches[key]
+    def _run(self):
+        num_failures = 0
+        while True:
+            with self._lock:
+                if self._stopped:
+                    return
+                watches = dict(self._watches)
+                self._wake.clear()
+            if len(watches) == 0:
+                # nothing to watch; wait until a subfeed is added (or we are stopped)
+                self._wake.wait()
+                continue
+            subfeed_watches = {key: w._watch_dict() for key, w in watches.items()}
+            try:
+                # the channel is given per watch
+                x = _watch_for_new_messages(subfeed_watches, wait_msec=self._wait_msec, signed=self._signed, max_num_messages=self._max_num_messages)
+            except Exception as e:
+                self._last_error = e
+                num_failures = num_failures + 1
+                delay = min(_FEED_WATCHER_INITIAL_BACKOFF_SEC * 2 ** (num_failures - 1), _FEED_WATCHER_MAX_BACKOFF_SEC)
+                print(f'WARNING: problem watching for new messages (retrying in {delay} sec): {str(e)}')
+                self._wake.wait(delay)
+                continue
+            self._last_error = None
+            num_failures = 0
+            with self._lock:
+                if self._stopped:
+                    return
+                # skip watches that were removed during the poll
+                to_deliver = [(w, x[key]) for key, w in watches.items() if len(x.get(key, [])) > 0 and self._watches.get(key, None) is w]
+            for w, messages in to_deliver:
+                w._deliver(messages)
+            if len(to_deliver) == 0:
+                # avoid spinning if the daemon returns early without messages
+                time.sleep(0.01)
@@ -1,24 +1,30 @@
 import hashlib
 import json
 import time
+import threading
 from os import wait
 from os.path import basename
-from typing import Union
+from typing import Any, Dict, List, Union
 from urllib.parse import quote, unquote
 
 from ._load_file import _load_json
 from ._store_file import _store_json
+from ._feed_snapshots import _SnapshotSubfeed, _create_snapshot_subfeed, _DEFAULT_SNAPSHOT_SEGMENT_SIZE
 from ._daemon_connection import _daemon_url
 from ._misc import _http_post_json, _http_get_json
 from ._mutables import _get, _set
 
 
 class Feed:
-    def __init__(self, uri, *, timeout_sec: Union[None, float]=None):
+    def __init__(self, uri, *, timeout_sec: Union[None, float]=None, channel: Union[str, None]=None):
+        # channel: the kachery channel from which the parts of a snapshot
+        # (sha1:// uri) that are not in the local kachery storage are loaded.
+        # Without a channel, all of its segments must be stored locally.
         if '://' not in uri:
             uri = f'feed://{uri}'
         self._feed_uri = uri
         self._timeout_sec = timeout_sec
+        self._channel = channel
         if uri.startswith('feed://'):
             feed_id, subfeed_name, position = _parse_feed_uri(uri)
             if subfeed_name is not None:
@@ -32,8 +38,10 @@ class Feed:
             self._feed_id = None
             self._is_writeable = False
             self._is_snapshot = True
-            self._snapshot_object = _load_json(uri)
+            self._snapshot_object = _load_json(uri, channel=channel)
             assert self._snapshot_object is not None, f'Unable to load snapshot: {uri}'
+            self._snapshot_subfeeds: Dict[str, _SnapshotSubfeed] = {}
+            self._snapshot_subfeeds_lock = threading.Lock()
         else:
             raise Exception(f'Unexpected feed uri: {uri}')
     def _initialize(self):
@@ -61,19 +69,45 @@ class Feed:
         return Subfeed(feed=self, subfeed_name=subfeed_name, position=position, channel=channel)
     def delete(self):
         _delete_feed(self.uri)
-    def create_snapshot(self, subfeed_names: list):
+    def create_snapshot(self, subfeed_names: list, *, previous_snapshot: Union[str, 'Feed', None]=None, segment_size: int=_DEFAULT_SNAPSHOT_SEGMENT_SIZE):
+        """Create a readonly snapshot of the given subfeeds and return it as a Feed (with a sha1:// URI)
+
+        The messages of each subfeed are stored in segments of segment_size
+        messages. If a previous snapshot of this feed is given, its full
+        segments are reused, so that only the messages added since then are
+        read and stored. The segments are separate kachery objects, so to read
+        the snapshot where they are not stored locally, load it with a channel
+        (see load_feed).
+
+        Args:
+            subfeed_names (list): The subfeeds to include
+            previous_snapshot (Union[str, Feed, None], optional): A previous snapshot (URI or Feed) of this feed. Defaults to None.
+            segment_size (int, optional): The number of messages per segment. Defaults to 10000.
+        """
+        if previous_snapshot is not None and not isinstance(previous_snapshot, Feed):
+            previous_snapshot = Feed(previous_snapshot)
+        if previous_snapshot is not None and not previous_snapshot.is_snapshot:
+            raise Exception('The previous snapshot is not a snapshot')
+        if previous_snapshot is not None and previous_snapshot._snapshot_object.get('feedId', None) != self._feed_id:
+            raise Exception(f'The previous snapshot is not a snapshot of this feed: {previous_snapshot.uri}')
         subfeeds = dict()
         for subfeed_name in subfeed_names:
             subfeed = self.load_subfeed(subfeed_name, channel='*local*')
-            messages = subfeed.get_next_messages(wait_msec=0)
-            subfeeds[subfeed.subfeed_hash] = dict(
-                subfeedHash=subfeed.subfeed_hash,
-                messages=messages
-            )
+            previous = previous_snapshot._snapshot_object['subfeeds'].get(subfeed.subfeed_hash, None) if previous_snapshot is not None else None
+            subfeeds[subfeed.subfeed_hash] = _create_snapshot_subfeed(subfeed, previous=previous, segment_size=segment_size)
         snapshot_uri = _store_json(dict(
+            feedId=self._feed_id,
             subfeeds=subfeeds
         ), basename='feed.json')
         return Feed(snapshot_uri)
+    def _get_snapshot_subfeed(self, subfeed_hash: str) -> _SnapshotSubfeed:
+        # only applies when feed is a snapshot; shared by the Subfeed objects of this feed
+        with self._snapshot_subfeeds_lock:
+            x = self._snapshot_subfeeds.get(subfeed_hash, None)
+            if x is None:
+                x = _SnapshotSubfeed(self._snapshot_object.get('subfeeds', {}).get(subfeed_hash, None), channel=self._channel)
+                self._snapshot_subfeeds[subfeed_hash] = x
+            return x
 
 def _subfeed_hash(subfeed_name):
     if isinstance(subfeed_name, str):
@@ -150,16 +184,7 @@ class Subfeed:
             assert x['success'], f'Unable to get num. messages for subfeed: {self._feed_id} {self._subfeed_name_str}'
             return x['numMessages']
         else:
-            messages = self._get_snapshot_messages()
-            return len(messages)
-        
-    def _get_snapshot_messages(self):
-        # only applies when feed is a snapshot
-        try:
-            obj = self._feed._snapshot_object['subfeeds'][self._subfeed_hash]
-            return obj['messages']
-        except:
-            return []
+            return self._feed._get_snapshot_subfeed(self._subfeed_hash).num_messages
 
     def get_next_messages(self, *, wait_msec=10, signed=False, max_num_messages=0, advance_position=True):
         if not self.is_snapshot:
@@ -176,12 +201,12 @@ class Subfeed:
                 self._position = self._position + len(y)
             return y
         else:
-            messages = self._get_snapshot_messages()
+            snapshot_subfeed = self._feed._get_snapshot_subfeed(self._subfeed_hash)
             position = self._position
             if max_num_messages > 0:
-                ret = messages[position:position + max_num_messages]
+                ret = snapshot_subfeed.get_messages(position, position + max_num_messages)
             else:
-                ret = messages[position:]
+                ret = snapshot_subfeed.get_messages(position, snapshot_subfeed.num_messages)
             if advance_position:
                 self._position = self._position + len(ret)
             return ret
@@ -194,36 +219,51 @@ class Subfeed:
             return None
         return messages[0]
     
-    def message_stream(self, *, signed=False):
-        class custom_iterator:
-            def __init__(self, parent):
-                self._parent = parent
-                self._messages = []
-                self._relative_position = 0
-                self._load_messages()
-            
-            def _load_messages(self):
-                messages = self._parent.get_next_messages(wait_msec=5000, signed=signed, advance_position=False)
-                if messages is None:
+    def message_stream(self, *, signed=False, max_num_messages=0, wait_msec=5000):
+        """Iterate over the messages of the subfeed, starting at the current position
+
+        The position is advanced as each message is consumed, and messages are
+        not retained after they have been consumed. When there are no new
+        messages, this blocks on the daemon's long poll (for a snapshot, the
+        iteration ends instead).
+
+        Args:
+            signed (bool, optional): Whether to retrieve signed messages. Defaults to False.
+            max_num_messages (int, optional): The maximum number of messages retrieved per request (0 for no limit). Defaults to 0.
+            wait_msec (int, optional): The duration of each long poll. Defaults to 5000.
+        """
+        while True:
+            messages = self.get_next_messages(wait_msec=wait_msec, signed=signed, max_num_messages=max_num_messages, advance_position=False)
+            if len(messages) == 0 and self.is_snapshot:
+                return
+            for msg in messages:
+                self._position = self._position + 1
+                yield msg
+
+    async def message_stream_async(self, *, signed=False, max_num_messages=0, wait_msec=5000):
+        """Async version of message_stream (for use with async for; requires aiohttp)"""
+        # imported here because kachery_client.aio imports this module
+        from .aio.main import watch_for_new_messages as _watch_for_new_messages_async
+        from .aio._misc import _run_blocking
+        while True:
+            if not self.is_snapshot:
+                subfeed_watches = {
+                    'watch': {
+                        'feedId': self._feed_id,
+                        'subfeedHash': self._subfeed_hash,
+                        'position': self._position
+                    }
+                }
+                x = await _watch_for_new_messages_async(subfeed_watches, channel=self._channel, wait_msec=wait_msec, signed=signed, max_num_messages=max_num_messages)
+                messages = x.get('watch', [])
+            else:
+                messages = await _run_blocking(self.get_next_messages, signed=signed, max_num_messages=max_num_messages, advance_position=False)
+                if len(messages) == 0:
                     return
-                for msg in messages:
-                    self._messages.append(msg)
-
-            def __iter__(self):
-                return self
-
-            def __next__(self):
-                while self._relative_position >= len(self._messages):
-                    self._load_messages()
-                    if self._relative_position >= len(self._messages):
-                        if self._parent.is_snapshot:
-                            raise StopIteration
-                        time.sleep(0.05)
-                self._parent._position = self._parent._position + 1
-                self._relative_position = self._relative_position + 1
-                return self._messages[self._relative_position - 1]
-        return custom_iterator(parent=self)
-    
+            for msg in messages:
+                self._position = self._position + 1
+                yield msg
+
     @property
     def is_snapshot(self):
         return self._feed.is_snapshot
@@ -243,6 +283,24 @@ class Subfeed:
     def append_message(self, message):
         self.append_messages([message])
 
+    def buffered_writer(self, *, max_num_messages=1000, max_num_bytes=1000000, max_delay_sec=0.1):
+        """Return a writer that appends messages to this subfeed in batches, in the background
+
+        Messages are sent when max_num_messages or (approximately)
+        max_num_bytes have been buffered, or max_delay_sec after the first
+        buffered message, whichever comes first. Errors from sending are
+        raised by the next call to append_message(s), flush or close. Use as a
+        context manager (or call close) to make sure all messages are sent.
+
+        Args:
+            max_num_messages (int, optional): Defaults to 1000.
+            max_num_bytes (int, optional): Defaults to 1000000.
+            max_delay_sec (float, optional): Defaults to 0.1.
+        """
+        if not self.is_writeable:
+            raise Exception('Cannot append messages to a readonly feed')
+        return SubfeedWriter(subfeed=self, max_num_messages=max_num_messages, max_num_bytes=max_num_bytes, max_delay_sec=max_delay_sec)
+
     def append_messages(self, messages):
         if not self.is_writeable:
             raise Exception('Cannot append messages to a readonly feed')
@@ -257,6 +315,122 @@ class Subfeed:
         if not x['success']:
             raise Exception(f'Unable to append messages: {x.get("error")}')
 
+class SubfeedWriter:
+    """Appends messages to a subfeed in batches, using a background thread (see Subfeed.buffered_writer)"""
+    def __init__(self, *, subfeed: Subfeed, max_num_messages: int, max_num_bytes: int, max_delay_sec: float):
+        self._subfeed = subfeed
+        self._max_num_messages = max_num_messages
+        self._max_num_bytes = max_num_bytes
+        self._max_delay_sec = max_delay_sec
+        self._condition = threading.Condition()
+        self._buffer: List[Any] = []
+        self._buffer_num_bytes = 0
+        # time when the first message in the buffer was added
+        self._buffer_time: Union[float, None] = None
+        self._num_sending = 0
+        self._flush_requested = False
+        self._error: Union[Exception, None] = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    def append_message(self, message):
+        self.append_messages([message])
+    def append_messages(self, messages):
+        num_bytes = sum([len(json.dumps(msg)) for msg in messages])
+        with self._condition:
+            self._raise_error_if_needed()
+            if self._closed:
+                raise Exception('Cannot append messages to a closed writer')
+            if self._buffer_time is None:
+                self._buffer_time = time.monotonic()
+            self._buffer.extend(messages)
+            self._buffer_num_bytes += num_bytes
+            self._condition.notify_all()
+    def flush(self):
+        """Send all buffered messages and wait until they have been appended"""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while (len(self._buffer) > 0 or self._num_sending > 0) and self._error is None:
+                self._condition.wait()
+            self._flush_requested = False
+            self._raise_error_if_needed()
+    def close(self):
+        """Flush and stop the background thread
+
+        If the buffered messages cannot be sent, sending is retried once, and
+        if that also fails the unsent messages are discarded and the error is
+        raised (the writer is closed either way).
+        """
+        try:
+            try:
+                self.flush()
+            except Exception:
+                self.flush()
+        except Exception:
+            with self._condition:
+                # do not resend the messages in the background after close()
+                # has raised
+                self._buffer = []
+                self._buffer_num_bytes = 0
+                self._buffer_time = None
+            raise
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    def _raise_error_if_needed(self):
+        # called with the condition held
+        if self._error is not None:
+            e = self._error
+            # the messages that failed to send stay in the buffer and are
+            # sent again on the next flush
+            self._error = None
+            raise e
+    def _ready_to_send(self) -> bool:
+        if len(self._buffer) == 0 or self._error is not None:
+            return False
+        if self._flush_requested or self._closed:
+            return True
+        if len(self._buffer) >= self._max_num_messages or self._buffer_num_bytes >= self._max_num_bytes:
+            return True
+        return self._buffer_time is not None and time.monotonic() - self._buffer_time >= self._max_delay_sec
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._ready_to_send():
+                    if self._closed and (len(self._buffer) == 0 or self._error is not None):
+                        return
+                    if len(self._buffer) > 0 and self._error is None:
+                        self._condition.wait(max(0, self._buffer_time + self._max_delay_sec - time.monotonic()))
+                    else:
+                        self._condition.wait()
+                batch = self._buffer[:self._max_num_messages]
+                self._buffer = self._buffer[self._max_num_messages:]
+                batch_num_bytes = self._buffer_num_bytes if len(self._buffer) == 0 else int(self._buffer_num_bytes * len(batch) / (len(batch) + len(self._buffer)))
+                self._buffer_num_bytes -= batch_num_bytes
+                self._buffer_time = time.monotonic() if len(self._buffer) > 0 else None
+                self._num_sending += 1
+            try:
+                self._subfeed.append_messages(batch)
+                error = None
+            except Exception as e:
+                error = e
+            with self._condition:
+                self._num_sending -= 1
+                if error is not None:
+                    # put the messages back so that order is preserved when they are resent
+                    self._buffer = batch + self._buffer
+                    self._buffer_num_bytes += batch_num_bytes
+                    if self._buffer_time is None:
+                        self._buffer_time = time.monotonic()
+                    self._error = error
+                self._condition.notify_all()
+
 def _create_feed(feed_name=None):
     daemon_url, headers = _daemon_url()
     url = f'{daemon_url}/feed/createFeed'
@@ -315,7 +489,7 @@ def _load_subfeed(subfeed_uri, *, channel: str='*local*'):
     assert subfeed_name is not None, 'No subfeed name found'
     return Feed('feed://' + feed_id).load_subfeed(subfeed_name=subfeed_name, position=position, channel=channel)
         
-def _load_feed(feed_name_or_uri, *, timeout_sec: Union[None, float]=None, create=False):
+def _load_feed(feed_name_or_uri, *, timeout_sec: Union[None, float]=None, create=False, channel: Union[str, None]=None):
     if feed_name_or_uri.startswith('feed://'):
         if create is True:
             raise Exception('Cannot use create=True when feed ID is specified.')
@@ -327,7 +501,7 @@ def _load_feed(feed_name_or_uri, *, timeout_sec: Union[None, float]=None, create
         if create is True:
             raise Exception('Cannot use create=True when feed is a snapshot.')
         feed_uri = feed_name_or_uri
-        return Feed(feed_uri)
+        return Feed(feed_uri, channel=channel)
     else:
         feed_name = feed_name_or_uri
         feed_id = _get_feed_id(feed_name, create=create)
@@ -336,23 +510,28 @@ def _load_feed(feed_name_or_uri, *, timeout_sec: Union[None, float]=None, create
 def _watch_for_new_messages(subfeed_watches, *, wait_msec, channel: str='*local*', signed=False, max_num_messages=0):
     daemon_url, headers = _daemon_url()
     url = f'{daemon_url}/feed/watchForNewMessages'
+    x = _http_post_json(url, _create_watch_for_new_messages_request(
+        subfeed_watches, wait_msec=wait_msec, channel=channel, signed=signed, max_num_messages=max_num_messages
+    ), headers=headers)
+    if not x['success']:
+        raise Exception(f'Unable to watch for new messages: {x["error"]}')
+    return x['messages']
+
+def _create_watch_for_new_messages_request(subfeed_watches, *, wait_msec, channel: str, signed: bool, max_num_messages: int) -> dict:
     subfeed_watches2 = {}
     for key, watch in subfeed_watches.items():
         subfeed_watches2[key] = {
             'feedId': watch['feedId'],
             'subfeedHash': watch.get('subfeedHash') if 'subfeedHash' in watch else _subfeed_hash(watch['subfeedName']),
-            'channelName': channel,
+            'channelName': watch.get('channelName', channel),
             'position': watch['position']
         }
-    x = _http_post_json(url, dict(
+    return dict(
         subfeedWatches=subfeed_watches2,
         waitMsec=wait_msec,
         signed=signed,
         maxNumMessages=max_num_messages
-    ), headers=headers)
-    if not x['success']:
-        raise Exception(f'Unable to watch for new messages: {x["error"]}')
-    return x['messages']
+    )
 
 def _parse_feed_uri(uri):
     listA = uri.split('?')
@@ -0,0 +1,164 @@
+import os
+import time
+import json
+import random
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Union
+
+# Persistent cache of the sha1 hashes (and manifests) of local files, stored in
+# an sqlite database in a directory owned by the client (not the kachery
+# storage directory, which belongs to the daemon, may be read-only for the
+# client, and may be on a network file system where sqlite locking is
+# unreliable). Entries are keyed by absolute path and are only valid while the
+# size, mtime and inode of the file are unchanged, so that large files do not
+# need to be re-read every time they are stored or linked. If the database
+# cannot be used, the cache is disabled for the rest of the process.
+
+# small files are fast to hash, so we don't bother caching them
+_MIN_FILE_SIZE_TO_CACHE = 100000
+
+_global = {
+    'disabled': False,
+    'removing_stale': False
+}
+_global_lock = threading.Lock()
+
+def _file_hash_cache_db_path() -> Union[str, None]:
+    if _global['disabled']:
+        return None
+    from pathlib import Path
+    cache_dir = os.getenv('KACHERY_CLIENT_CACHE_DIR', f'{str(Path.home())}/.kachery-client')
+    os.makedirs(cache_dir, exist_ok=True)
+    return f'{cache_dir}/file-hash-cache.db'
+
+def _disable_file_hash_cache(e: Exception) -> None:
+    if not _global['disabled']:
+        _global['disabled'] = True
+        print(f'WARNING: disabling file hash cache: {str(e)}')
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    # timeout: wait for other processes that are writing to the database
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS file_hashes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            sha1 TEXT NOT NULL,
+            manifest_sha1 TEXT,
+            manifest TEXT
+        )
+    ''')
+    return conn
+
+def _stat_key(s: os.stat_result):
+    return (s.st_size, s.st_mtime_ns, s.st_ino)
+
+def _get_cached_file_hash(path: str) -> Union[dict, None]:
+    """Return dict with sha1, manifest_sha1 and manifest (the latter two may be None) if the file hash is cached and still valid"""
+    path = os.path.abspath(path)
+    try:
+        s = os.stat(path)
+        if s.st_size < _MIN_FILE_SIZE_TO_CACHE:
+            return None
+    except OSError:
+        return None
+    try:
+        db_path = _file_hash_cache_db_path()
+        if db_path is None:
+            return None
+        with closing(_connect(db_path)) as conn, conn:
+            row = conn.execute('SELECT size, mtime_ns, inode, sha1, manifest_sha1, manifest FROM file_hashes WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return None
+            if (row[0], row[1], row[2]) != _stat_key(s):
+                # the file has changed since it was hashed
+                conn.execute('DELETE FROM file_hashes WHERE path = ?', (path,))
+                return None
+    except (OSError, sqlite3.Error) as e:
+        _disable_file_hash_cache(e)
+        return None
+    return {
+        'sha1': row[3],
+        'manifest_sha1': row[4],
+        'manifest': json.loads(row[5]) if row[5] is not None else None
+    }
+
+def _set_cached_file_hash(path: str, *, stat: os.stat_result, sha1: str, manifest_sha1: Union[str, None]=None, manifest: Union[dict, None]=None) -> None:
+    """Record the hash of a file. The stat should be taken before the file was read, so we can tell whether it changed while hashing."""
+    path = os.path.abspath(path)
+    try:
+        s = os.stat(path)
+    except OSError:
+        return
+    if s.st_size < _MIN_FILE_SIZE_TO_CACHE:
+        return
+    if _stat_key(s) != _stat_key(stat):
+        # the file changed while we were hashing it
+        return
+    if time.time() - s.st_mtime < 1:
+        # the file may still be changing without the mtime being updated
+        return
+    try:
+        db_path = _file_hash_cache_db_path()
+        if db_path is None:
+            return
+        with closing(_connect(db_path)) as conn, conn:
+            # keep fields from the existing entry (if still valid) that were not provided
+            row = conn.execute('SELECT size, mtime_ns, inode, sha1, manifest_sha1, manifest FROM file_hashes WHERE path = ?', (path,)).fetchone()
+            manifest_json = json.dumps(manifest) if manifest is not None else None
+            if row is not None and (row[0], row[1], row[2]) == _stat_key(s) and row[3] == sha1:
+                if manifest_sha1 is None:
+                    manifest_sha1 = row[4]
+                if manifest_json is None:
+                    manifest_json = row[5]
+            conn.execute(
+                'INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, inode, sha1, manifest_sha1, manifest) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, s.st_size, s.st_mtime_ns, s.st_ino, sha1, manifest_sha1, manifest_json)
+            )
+    except (OSError, sqlite3.Error) as e:
+        _disable_file_hash_cache(e)
+        return
+    if random.random() < 0.001:
+        # every so often, evict the entries for files that have changed or no
+        # longer exist (in the background, since this stats every entry)
+        _start_removing_stale_cached_file_hashes()
+
+def _start_removing_stale_cached_file_hashes() -> None:
+    with _global_lock:
+        if _global['removing_stale']:
+            return
+        _global['removing_stale'] = True
+    def run():
+        try:
+            _remove_stale_cached_file_hashes()
+        except (OSError, sqlite3.Error) as e:
+            print(f'WARNING: problem removing stale entries from file hash cache: {str(e)}')
+        finally:
+            _global['removing_stale'] = False
+    threading.Thread(target=run, daemon=True).start()
+
+def _remove_stale_cached_file_hashes() -> int:
+    """Remove the entries for files that have changed or no longer exist, and return the number removed"""
+    db_path = _file_hash_cache_db_path()
+    if db_path is None or not os.path.exists(db_path):
+        return 0
+    with closing(_connect(db_path)) as conn:
+        rows = conn.execute('SELECT path, size, mtime_ns, inode FROM file_hashes').fetchall()
+        # the files are checked outside of any transaction, so that writers are not blocked
+        stale_rows = []
+        for row in rows:
+            try:
+                s = os.stat(row[0])
+            except OSError:
+                stale_rows.append(row)
+                continue
+            if (row[1], row[2], row[3]) != _stat_key(s):
+                stale_rows.append(row)
+        with conn:
+            # only delete entries that were not updated in the meantime
+            conn.executemany('DELETE FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?', stale_rows)
+    return len(stale_rows)
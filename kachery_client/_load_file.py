@@ -1,15 +1,19 @@
 import sys
 import os
 import shutil
-from typing import Any, Union
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Tuple, Union, cast
 import simplejson
 import numpy as np
-from ._daemon_connection import _daemon_url, _kachery_storage_dir, _connected_to_daemon
+from ._daemon_connection import _daemon_url, _kachery_storage_dir, _connected_to_daemon, _offline_mode
 from ._misc import _create_file_key, _http_post_json_receive_json_socket, _parse_kachery_uri
 from ._exceptions import LoadFileError
-from ._local_kachery_storage import _local_kachery_storage_load_file, _local_kachery_storage_load_bytes
+from ._local_kachery_storage import _local_kachery_storage_load_file, _local_kachery_storage_load_files, _local_kachery_storage_load_bytes, _memoryview_of_local_file
 from ._safe_pickle import _safe_unpickle
 from .enable_ephemeral import _use_ephemeral
+from .load_cache import _load_cache_enabled, _load_with_cache
+from ._sparse_file_cache import _get_sparse_file_cache
 
 def _load_file(uri: str, dest: Union[str, None]=None, *, local_only: bool=False, channel: Union[str, None]=None) -> Union[str, None]:
     if not uri.startswith('sha1://'):
@@ -37,16 +41,12 @@ def _load_file(uri: str, dest: Union[str, None]=None, *, local_only: bool=False,
     # first check the local kachery storage (if kachery storage dir is known)
     if _kachery_storage_dir():
         if True: # for debugging (not loading locally) switch to false
-            protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
-            if protocol != 'sha1':
-                raise Exception(f'Protocol not supported: {protocol}')
-            local_path = _local_kachery_storage_load_file(sha1_hash=hash0)
+            local_path = _load_file_from_local_kachery_storage(uri, dest=dest)
             if local_path is not None:
-                if dest is not None:
-                    shutil.copyfile(local_path, dest)
-                    return dest
-                else:
-                    return local_path
+                return local_path
+    if _offline_mode():
+        # files are only resolved from the local kachery storage
+        return None
     if not _connected_to_daemon():
         raise Exception('Not connected to a kachery daemon and not in ephemeral mode.')
     
@@ -56,40 +56,67 @@ def _load_file(uri: str, dest: Union[str, None]=None, *, local_only: bool=False,
     if channel is None:
         return None
     
+    return _load_file_from_daemon(uri, channel=channel)
+
+def _load_file_from_local_kachery_storage(uri: str, *, dest: Union[str, None]=None) -> Union[str, None]:
+    protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+    if protocol != 'sha1':
+        raise Exception(f'Protocol not supported: {protocol}')
+    local_path = _local_kachery_storage_load_file(sha1_hash=hash0)
+    if local_path is not None:
+        if dest is not None:
+            shutil.copyfile(local_path, dest)
+            return dest
+        else:
+            return local_path
+    return None
+
+def _create_load_file_request(uri: str, *, channel: str) -> dict:
     protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
     assert algorithm == 'sha1'
     file_key = _create_file_key(sha1=hash0, query=query)
-    daemon_url, headers = _daemon_url()
-    url = f'{daemon_url}/loadFile'
-    sock, req = _http_post_json_receive_json_socket(url, dict(
+    return dict(
         fileKey=file_key,
         channelName=channel
-    ), headers=headers)
+    )
+
+def _process_load_file_message(r: Any, uri: str) -> Tuple[bool, Union[str, None]]:
+    # handle a message streamed by the daemon's /loadFile endpoint
+    # returns (done, local_file_path)
+    try:
+        type0 = r.get('type')
+    except:
+        raise Exception(f'Unexpected response from daemon: {r}: {uri}')
+    if type0 == 'finished':
+        print(f'Loaded file: {uri}')
+        local_file_path: str = r['localFilePath']
+        if not os.path.exists(local_file_path):
+            raise Exception(f'Unexpected in load_file: file does not exist: {local_file_path}')
+        return True, local_file_path
+    elif type0 == 'progress':
+        bytes_loaded = r['bytesLoaded']
+        bytes_total = r['bytesTotal']
+        if bytes_total > 0:
+            pct = (bytes_loaded / bytes_total) * 100
+        else:
+            pct = 100
+        print(f'Loaded {bytes_loaded} of {bytes_total} bytes ({pct:.1f} %): {uri}')
+        return False, None
+    elif type0 == 'error':
+        return True, None
+        # raise LoadFileError(f'Error loading file: {r["error"]}: {uri}')
+    else:
+        raise Exception(f'Unexpected message from daemon: {r}')
+
+def _load_file_from_daemon(uri: str, *, channel: str) -> Union[str, None]:
+    daemon_url, headers = _daemon_url()
+    url = f'{daemon_url}/loadFile'
+    sock, req = _http_post_json_receive_json_socket(url, _create_load_file_request(uri, channel=channel), headers=headers)
     try:
         for r in sock:
-            try:
-                type0 = r.get('type')
-            except:
-                raise Exception(f'Unexpected response from daemon: {r}: {uri}')
-            if type0 == 'finished':
-                print(f'Loaded file: {uri}')
-                local_file_path: str = r['localFilePath']
-                if not os.path.exists(local_file_path):
-                    raise Exception(f'Unexpected in load_file: file does not exist: {local_file_path}')
+            done, local_file_path = _process_load_file_message(r, uri)
+            if done:
                 return local_file_path
-            elif type0 == 'progress':
-                bytes_loaded = r['bytesLoaded']
-                bytes_total = r['bytesTotal']
-                if bytes_total > 0:
-                    pct = (bytes_loaded / bytes_total) * 100
-                else:
-                    pct = 100
-                print(f'Loaded {bytes_loaded} of {bytes_total} bytes ({pct:.1f} %): {uri}')
-            elif type0 == 'error':
-                return None
-                # raise LoadFileError(f'Error loading file: {r["error"]}: {uri}')
-            else:
-                raise Exception(f'Unexpected message from daemon: {r}')
         # for url in _global_config['file_server_urls']:
         #     try:
         #         path = _load_file_from_file_server(uri=uri, dest=dest, file_server_url=url)
@@ -102,33 +129,134 @@ def _load_file(uri: str, dest: Union[str, None]=None, *, local_only: bool=False,
     finally:
         req.close()
 
-def _load_json(uri: str, *, local_only: bool=False, channel: Union[str, None]=None) -> Union[dict, None]:
-    local_path = _load_file(uri, local_only=local_only, channel=channel)
-    if local_path is None:
+def _load_files(uris: List[str], *, local_only: bool=False, channel: Union[str, None]=None, max_concurrency: int=4) -> Dict[str, Union[str, None]]:
+    ret: Dict[str, Union[str, None]] = {}
+    # group the sha1 URIs by hash so that each file is only loaded once
+    uris_by_hash: Dict[str, List[str]] = {}
+    for uri in uris:
+        if uri in ret:
+            continue
+        if not uri.startswith('sha1://'):
+            ret[uri] = _load_file_or_report_error(uri, local_only=local_only, channel=channel)
+            continue
+        try:
+            protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+            if protocol != 'sha1':
+                raise Exception(f'Protocol not supported: {protocol}')
+        except Exception as e:
+            print(f'Problem loading file: {uri}: {str(e)}')
+            ret[uri] = None
+            continue
+        ret[uri] = None
+        uris_by_hash.setdefault(hash0, []).append(uri)
+
+    hashes_to_load: List[str] = []
+    if _use_ephemeral():
+        # the ephemeral loader checks its own local storage
+        hashes_to_load = list(uris_by_hash.keys())
+    else:
+        # first check the local kachery storage in a single pass (if kachery storage dir is known)
+        if _kachery_storage_dir():
+            local_paths = _local_kachery_storage_load_files(sha1_hashes=list(uris_by_hash.keys()))
+            for hash0, hash_uris in uris_by_hash.items():
+                local_path = local_paths[hash0]
+                if local_path is not None:
+                    for uri in hash_uris:
+                        ret[uri] = local_path
+                else:
+                    hashes_to_load.append(hash0)
+        else:
+            hashes_to_load = list(uris_by_hash.keys())
+        if _offline_mode():
+            # files are only resolved from the local kachery storage
+            return ret
+        if len(hashes_to_load) > 0 and (not _connected_to_daemon()):
+            raise Exception('Not connected to a kachery daemon and not in ephemeral mode.')
+        if local_only or (channel is None):
+            return ret
+
+    # load the rest concurrently
+    use_ephemeral = _use_ephemeral()
+    def load_hash(hash0: str) -> Union[str, None]:
+        hash_uris = uris_by_hash[hash0]
+        # prefer a URI that includes a manifest
+        uri = next((u for u in hash_uris if 'manifest=' in u), hash_uris[0])
+        if use_ephemeral:
+            return _load_file_or_report_error(uri, local_only=local_only, channel=channel)
+        try:
+            # we already know that the file is not in the local kachery storage
+            return _load_file_from_daemon(uri, channel=cast(str, channel))
+        except Exception as e:
+            print(f'Problem loading file: {uri}: {str(e)}')
+            return None
+
+    if len(hashes_to_load) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            for hash0, local_path in zip(hashes_to_load, executor.map(load_hash, hashes_to_load)):
+                for uri in uris_by_hash[hash0]:
+                    ret[uri] = local_path
+    return ret
+
+def _load_file_or_report_error(uri: str, *, local_only: bool, channel: Union[str, None]) -> Union[str, None]:
+    try:
+        return _load_file(uri, local_only=local_only, channel=channel)
+    except Exception as e:
+        print(f'Problem loading file: {uri}: {str(e)}')
         return None
-    with open(local_path, 'r') as f:
-        return simplejson.load(f)
+
+def _load_json(uri: str, *, local_only: bool=False, channel: Union[str, None]=None) -> Union[dict, None]:
+    return _load_and_parse(uri, kind='json', parse=_parse_json_file, local_only=local_only, channel=channel)
 
 def _load_text(uri: str, *, local_only: bool=False, channel: Union[str, None]=None) -> Union[str, None]:
-    local_path = _load_file(uri, local_only=local_only, channel=channel)
-    if local_path is None:
+    return _load_and_parse(uri, kind='text', parse=_parse_text_file, local_only=local_only, channel=channel)
+
+def _load_npy(uri: str, *, local_only: bool=False, channel: Union[str, None]=None, mmap_mode: Union[str, None]=None) -> Union[np.ndarray, Any, None]:
+    if mmap_mode not in [None, 'r', 'c']:
+        # files in kachery storage are immutable
+        raise Exception(f'Unsupported mmap_mode for load_npy: {mmap_mode}')
+    if mmap_mode is not None:
+        # memory-mapped arrays are already shared, so they are not cached
+        local_path = _load_file(uri, local_only=local_only, channel=channel)
+        if local_path is None:
+            return None
+        return np.load(local_path, mmap_mode=mmap_mode, allow_pickle=False)
+    return _load_and_parse(uri, kind='npy', parse=_parse_npy_file, local_only=local_only, channel=channel)
+
+def _load_pkl(uri: str, *, local_only: bool=False, channel: Union[str, None]=None) -> Union[np.ndarray, None]:
+    return _load_and_parse(uri, kind='pkl', parse=_safe_unpickle, local_only=local_only, channel=channel)
+
+def _load_and_parse(uri: str, *, kind: str, parse: Callable[[str], Any], local_only: bool, channel: Union[str, None]) -> Any:
+    def load():
+        local_path = _load_file(uri, local_only=local_only, channel=channel)
+        if local_path is None:
+            return None
+        return parse(local_path), os.path.getsize(local_path)
+    if _load_cache_enabled() and uri.startswith('sha1://'):
+        protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+        return _load_with_cache(kind, hash0, load)
+    a = load()
+    if a is None:
         return None
-    with open(local_path, 'r') as f:
+    return a[0]
+
+def _parse_json_file(path: str):
+    with open(path, 'r') as f:
+        return simplejson.load(f)
+
+def _parse_text_file(path: str):
+    with open(path, 'r') as f:
         return f.read()
 
-def _load_npy(uri: str, *, local_only: bool=False, channel: Union[str, None]=None) -> Union[np.ndarray, Any, None]:
-    local_path = _load_file(uri, local_only=local_only, channel=channel)
-    if local_path is None:
-        return None
-    return np.load(local_path, allow_pickle=False)
+def _parse_npy_file(path: str):
+    return np.load(path, allow_pickle=False)
 
-def _load_pkl(uri: str, *, local_only: bool=False, channel: Union[str, None]=None) -> Union[np.ndarray, None]:
+def _load_buffer(uri: str, start: Union[int, None]=None, end: Union[int, None]=None, *, local_only: bool=False, channel: Union[str, None]=None) -> Union[memoryview, None]:
     local_path = _load_file(uri, local_only=local_only, channel=channel)
     if local_path is None:
         return None
-    return _safe_unpickle(local_path)
+    return _memoryview_of_local_file(local_path, start=start, end=end)
 
-def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], *, write_to_stdout=False, local_only: bool=False, channel: Union[str, None]=None) -> Union[bytes, None]: 
+def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], *, write_to_stdout=False, local_only: bool=False, channel: Union[str, None]=None, max_concurrency: int=4) -> Union[bytes, None]: 
     if not uri.startswith('sha1://'):
         if os.path.isfile(uri):
             local_path = uri
@@ -136,6 +264,17 @@ def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], *, wri
         else:
             raise Exception(f'Local file not found: {uri}')
     
+    if _use_ephemeral():
+        # ranged reads from the channel buckets, using the sparse file cache
+        from .ephemeral.ephemeral_load_file import ephemeral_load_bytes
+        data = ephemeral_load_bytes(uri, start=start, end=end, local_only=local_only, channel=channel)
+        if data is None:
+            return None
+        if write_to_stdout:
+            sys.stdout.buffer.write(data)
+            return None
+        return data
+
     # first check the local kachery storage (if kachery storage dir is known)
     if _kachery_storage_dir():
         protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
@@ -145,8 +284,18 @@ def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], *, wri
         if bytes0 is not None:
             return bytes0
     
-    if local_only:
+    if local_only or _offline_mode():
         return None
+
+    if start is not None and end is not None:
+        # the range may have been cached by a previous ranged read (e.g., by a DirectClient)
+        protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+        data = _get_sparse_file_cache().read(hash0, start=start, end=end, size=None, fetch=None)
+        if data is not None:
+            if write_to_stdout:
+                sys.stdout.buffer.write(data)
+                return None
+            return data
     
     if channel is None:
         return None
@@ -158,38 +307,71 @@ def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], *, wri
             print('Unable to load manifest')
             return None
         assert manifest['sha1'] == hash0, 'Manifest sha1 does not match expected.'
-        data_chunks = []
-        chunks_to_load = []
-        for ch in manifest['chunks']:
-            if start < ch['end'] and end > ch['start']:
-                chunks_to_load.append(ch)
-        for ii, ch in enumerate(chunks_to_load):
-            if len(chunks_to_load) > 4:
-                print(f'load_bytes: Loading chunk {ii + 1} of {len(chunks_to_load)}')
-            chunk_uri = f'sha1://{ch["sha1"]}?chunkOf={hash0}~{ch["start"]}~{ch["end"]}'
-            chunk_path = _load_file(chunk_uri, channel=channel)
-            if chunk_path is None:
-                print(f'Problem loading chunk: {chunk_uri}')
-                return None
-            start_byte = max(0, start - ch['start'])
-            end_byte = min(ch['end']-ch['start'], end-ch['start'])
-            a = _load_bytes(
-                uri=chunk_path,
-                start=start_byte,
-                end=end_byte,
-                channel=channel
-            )
-            if a is None:
-                print(f'Unable to load bytes from chunk: {chunk_path} (start={start_byte}; end={end_byte})')
-                return None
-            data_chunks.append(a)
-        return b''.join(data_chunks)
+        if start is None:
+            start = 0
+        if end is None:
+            end = manifest['size']
+        data = _load_bytes_from_manifest_chunks(hash0=hash0, manifest=manifest, start=start, end=end, channel=channel, max_concurrency=max_concurrency)
+        if data is None:
+            return None
+        if write_to_stdout:
+            sys.stdout.buffer.write(data)
+            return None
+        return data
     
     path = _load_file(uri=uri, channel=channel)
     if path is None:
         print('Unable to load file.')
         return None
-    bytes0 = _local_kachery_storage_load_bytes(sha1_hash=hash0, start=start, end=end, write_to_stdout=write_to_stdout)
+    return _load_bytes_from_local_file(path, start=start, end=end, write_to_stdout=write_to_stdout)
+
+def _load_bytes_from_manifest_chunks(*, hash0: str, manifest: dict, start: int, end: int, channel: str, max_concurrency: int) -> Union[bytes, None]:
+    # load the chunks that overlap the byte range in parallel (at most max_concurrency at a time)
+    # and assemble them in order
+    chunks_to_load = []
+    for ch in manifest['chunks']:
+        if start < ch['end'] and end > ch['start']:
+            chunks_to_load.append(ch)
+    if len(chunks_to_load) == 0:
+        return bytes()
+    verbose = len(chunks_to_load) > 4
+    progress = {'num_chunks_loaded': 0, 'bytes_loaded': 0}
+    bytes_total = sum([min(end, ch['end']) - max(start, ch['start']) for ch in chunks_to_load])
+    progress_lock = threading.Lock()
+
+    def load_chunk_bytes(ch: dict) -> Union[bytes, None]:
+        chunk_uri = f'sha1://{ch["sha1"]}?chunkOf={hash0}~{ch["start"]}~{ch["end"]}'
+        chunk_path = _load_file(chunk_uri, channel=channel)
+        if chunk_path is None:
+            print(f'Problem loading chunk: {chunk_uri}')
+            return None
+        start_byte = max(0, start - ch['start'])
+        end_byte = min(ch['end']-ch['start'], end-ch['start'])
+        a = _load_bytes_from_local_file(chunk_path, start=start_byte, end=end_byte)
+        if a is None:
+            print(f'Unable to load bytes from chunk: {chunk_path} (start={start_byte}; end={end_byte})')
+            return None
+        with progress_lock:
+            progress['num_chunks_loaded'] += 1
+            progress['bytes_loaded'] += len(a)
+            if verbose:
+                print(f'load_bytes: Loaded chunk {progress["num_chunks_loaded"]} of {len(chunks_to_load)} ({progress["bytes_loaded"]} of {bytes_total} bytes)')
+        return a
+
+    data_chunks: List[Union[bytes, None]] = [None for _ in chunks_to_load]
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = {executor.submit(load_chunk_bytes, ch): ii for ii, ch in enumerate(chunks_to_load)}
+        try:
+            for future in as_completed(futures):
+                a = future.result()
+                if a is None:
+                    return None
+                data_chunks[futures[future]] = a
+        finally:
+            # don't start any chunks that are still pending if we are bailing out
+            for future in futures:
+                future.cancel()
+    return b''.join(cast(List[bytes], data_chunks))
 
 def _load_bytes_from_local_file(local_fname: str, *, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout: bool=False) -> Union[bytes, None]:
     size0 = os.path.getsize(local_fname)
@@ -1,81 +1,258 @@
 import os
 import sys
+import mmap
 import hashlib
 import shutil
+import stat
 import random
 import json
-from typing import Optional, Tuple, Union
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple, Union
 from ._misc import _parse_kachery_uri
 from ._daemon_connection import _kachery_storage_dir
+from ._file_hash_cache import _get_cached_file_hash, _set_cached_file_hash
+from .local_storage_index import _local_storage_index_lookup, _local_storage_index_lookup_many, _add_to_local_storage_index, _remove_from_local_storage_index
 
 
-def _local_kachery_storage_load_file(*, sha1_hash: str):
+def _local_kachery_storage_load_file(*, sha1_hash: str, _index_entry: Union[Tuple[str, bool], None]=None):
+    # _index_entry: result of a (bulk) index lookup that was already made for this hash
+    if _index_entry is None:
+        _index_entry = _local_storage_index_lookup(sha1_hash)
+    if _index_entry is not None:
+        path, is_link = _index_entry
+        if not is_link:
+            return path
+        linked_file_path = _find_linked_file(path)
+        if linked_file_path is not None:
+            return linked_file_path
+        # stale index entry
+        _remove_from_local_storage_index(sha1_hash)
     sha1_directory = f'{_kachery_storage_dir()}/sha1'
     path = _get_path_ext(hash=sha1_hash, create=False, directory=sha1_directory)
     if os.path.exists(path):
+        _add_to_local_storage_index(sha1_hash, is_link=False)
         return path
     elif os.path.exists(path + '.link'):
         linked_file_path = _find_linked_file(path + '.link')
         if linked_file_path is not None:
+            _add_to_local_storage_index(sha1_hash, is_link=True)
             return linked_file_path
     return None
 
+def _local_kachery_storage_load_files(*, sha1_hashes: List[str], max_concurrency: int=8) -> Dict[str, Union[str, None]]:
+    # resolve many hashes at once (file system calls are made in parallel, which helps on network file systems)
+    if len(sha1_hashes) == 0:
+        return {}
+    index_entries = _local_storage_index_lookup_many(sha1_hashes)
+    def load(sha1_hash: str):
+        return _local_kachery_storage_load_file(sha1_hash=sha1_hash, _index_entry=index_entries[sha1_hash])
+    if len(sha1_hashes) == 1 or max_concurrency <= 1:
+        return {h: load(h) for h in sha1_hashes}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return dict(zip(sha1_hashes, executor.map(load, sha1_hashes)))
+
+# Parsed .link records, keyed by the path of the .link file. A record is
+# valid while the size and mtime of the .link file are unchanged.
+_link_record_cache: 'OrderedDict[str, Tuple[Tuple[int, int], dict]]' = OrderedDict()
+_link_record_cache_lock = threading.Lock()
+_LINK_RECORD_CACHE_MAX_SIZE = 500000
+
+# Problems found when resolving links (link path -> reason). These are not
+# printed on the hot path; see _find_stale_links().
+_stale_links: Dict[str, str] = {}
+
+def _read_link_record(link_path: str) -> Union[dict, None]:
+    try:
+        s = os.stat(link_path)
+    except OSError:
+        return None
+    key = (s.st_size, s.st_mtime_ns)
+    with _link_record_cache_lock:
+        a = _link_record_cache.get(link_path, None)
+        if a is not None and a[0] == key:
+            _link_record_cache.move_to_end(link_path)
+            return a[1]
+    try:
+        with open(link_path, 'r') as f:
+            link: dict = json.load(f)
+    except (OSError, ValueError):
+        return None
+    with _link_record_cache_lock:
+        _link_record_cache[link_path] = (key, link)
+        while len(_link_record_cache) > _LINK_RECORD_CACHE_MAX_SIZE:
+            _link_record_cache.popitem(last=False)
+    return link
+
 def _find_linked_file(link_path: str):
-    with open(link_path, 'r') as f:
-        link: dict = json.load(f)
+    path, problem = _check_link(link_path)
+    if problem is not None:
+        _stale_links[link_path] = problem
+        return None
+    _stale_links.pop(link_path, None)
+    return path
+
+def _check_link(link_path: str) -> Tuple[Union[str, None], Union[str, None]]:
+    # returns (linked file path, problem) where problem is None if the link is valid
+    link = _read_link_record(link_path)
+    if link is None:
+        return None, 'unable to read link'
     path = link.get('path', None)
     if path is None:
-        print(f'WARNING: problem with link (no path field): {link_path}')
-        return None
+        return None, 'no path field'
     stat = link.get('stat', None)
     if stat is None:
-        print(f'WARNING: problem with link (no stat field): {link_path}')
-        return None
-    if os.path.exists(path):
-        if _stat_matches(stat, path):
-            return path
-        else:
-            print(f'WARNING: linked file may have been modified: {link_path} {path}')
-            return None
-    else:
-        print('WARNING: linked file does not exist: {link_path} {path}')
-    return None
+        return None, 'no stat field'
+    try:
+        s = os.stat(path)
+    except OSError:
+        return None, 'linked file does not exist'
+    if not _stat_matches(stat, s):
+        return None, 'linked file may have been modified'
+    return path, None
 
-def _stat_matches(stat: dict, path: str):
-    s = os.stat(path)
+def _stat_matches(stat: dict, s: os.stat_result):
     if stat['size'] != s.st_size:
         return False
     if stat['mtime'] != s.st_mtime:
         return False
     return True
-    
-def _local_kachery_storage_load_bytes(*, sha1_hash: str, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout: bool=False):
+
+def _find_linked_files(link_paths: List[str], *, max_concurrency: int=8) -> Dict[str, Union[str, None]]:
+    """Resolve many .link files, validating the linked files in parallel (stat calls are slow on network file systems)"""
+    if len(link_paths) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        return dict(zip(link_paths, executor.map(_find_linked_file, link_paths)))
+
+def _find_stale_links(*, max_concurrency: int=8) -> List[dict]:
+    """Walk all .link files in the local kachery storage and return a list of {link_path, path, problem} for those that are no longer valid"""
     sha1_directory = f'{_kachery_storage_dir()}/sha1'
-    path = _get_path_ext(hash=sha1_hash, create=False, directory=sha1_directory)
-    if os.path.exists(path):
-        return _load_bytes_from_local_file(local_fname=path, start=start, end=end, write_to_stdout=write_to_stdout)
-    else:
+    link_paths: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(sha1_directory):
+        for fname in filenames:
+            if fname.endswith('.link') and len(fname) == 45:
+                link_paths.append(os.path.join(dirpath, fname))
+    _find_linked_files(link_paths, max_concurrency=max_concurrency)
+    ret: List[dict] = []
+    for link_path in link_paths:
+        problem = _stale_links.get(link_path, None)
+        if problem is not None:
+            link = _read_link_record(link_path)
+            ret.append({
+                'link_path': link_path,
+                'path': link.get('path', None) if link is not None else None,
+                'problem': problem
+            })
+    return ret
+
+def _local_kachery_storage_load_bytes(*, sha1_hash: str, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout: bool=False):
+    path = _local_kachery_storage_load_file(sha1_hash=sha1_hash)
+    if path is None:
         return None
+    try:
+        return _load_bytes_from_local_file(local_fname=path, start=start, end=end, write_to_stdout=write_to_stdout)
+    except FileNotFoundError:
+        # the in-memory index may report files that were removed by other means
+        _remove_from_local_storage_index(sha1_hash)
+        path = _local_kachery_storage_load_file(sha1_hash=sha1_hash)
+        if path is None:
+            return None
+        return _load_bytes_from_local_file(local_fname=path, start=start, end=end, write_to_stdout=write_to_stdout)
 
-def _local_kachery_storage_store_file(*, path: str, _no_manifest=False) -> Tuple[str, str, Union[str, None]]:
-    from ._store_file import _store_json # don't want circular dependencies
-    if (not _no_manifest) and (os.path.getsize(path) > 20000000):
-        hash0, manifest0 = _compute_local_file_sha1_and_manifest(path)
-        if manifest0 is None:
-            raise Exception(f'Unable to compute hash of file: {path}')
-        manifest_uri = _store_json(manifest0)
-        protocol, algorithm, manifest_hash, additional_path, query = _parse_kachery_uri(manifest_uri)
+_STORE_STRATEGIES = ['auto', 'reflink', 'hardlink', 'copy_file_range', 'copy']
+
+def _store_strategy() -> str:
+    strategy = os.getenv('KACHERY_STORE_STRATEGY', 'auto')
+    if strategy not in _STORE_STRATEGIES:
+        raise Exception(f'Invalid KACHERY_STORE_STRATEGY: {strategy} (expected one of {", ".join(_STORE_STRATEGIES)})')
+    return strategy
+
+def _copy_file_into_storage(src: str, dest: str, *, strategy: Union[str, None]=None) -> str:
+    """Copy a file into the kachery storage (atomically) and return the method that was used
+
+    With the 'auto' strategy (the default, see KACHERY_STORE_STRATEGY) the
+    methods are tried in order: 'reflink' (copy-on-write clone, on file systems
+    that support it), 'hardlink' (only for read-only sources, since stored files
+    must not change), 'copy_file_range' (in-kernel copy), and finally 'copy'.
+    With any other strategy, only that method is tried before falling back to
+    'copy'.
+    """
+    if strategy is None:
+        strategy = _store_strategy()
+    if strategy == 'auto':
+        methods = ['reflink', 'hardlink', 'copy_file_range']
+    elif strategy == 'copy':
+        methods = []
     else:
-        hash0 = _get_file_hash(path)
-        manifest_hash = None
-    assert hash0 is not None
-    sha1_directory = f'{_kachery_storage_dir()}/sha1'
-    path0 = _get_path_ext(hash=hash0, create=True, directory=sha1_directory)
-    if not os.path.exists(path0):
-        tmp_path = path0 + '.copying.' + _random_string(6)
-        shutil.copyfile(path, tmp_path)
-        _rename_file(tmp_path, path0, remove_if_exists=False)
-    return path0, hash0, manifest_hash
+        methods = [strategy]
+    for method in methods + ['copy']:
+        tmp_path = dest + '.copying.' + _random_string(6)
+        if method == 'copy':
+            ok = _store_by_copy(src, tmp_path)
+        else:
+            try:
+                ok = _store_methods[method](src, tmp_path)
+            except OSError:
+                # not supported for this file system (or between file systems)
+                ok = False
+        if ok:
+            _rename_file(tmp_path, dest, remove_if_exists=False)
+            if os.path.exists(tmp_path):
+                # the file was stored by someone else in the meantime
+                os.unlink(tmp_path)
+            return method
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    raise Exception(f'Unable to copy file into kachery storage: {src}')
+
+# Linux ioctl for cloning a file (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+def _store_by_reflink(src: str, dest: str) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    if not sys.platform.startswith('linux'):
+        return False
+    with open(src, 'rb') as f1, open(dest, 'wb') as f2:
+        fcntl.ioctl(f2.fileno(), _FICLONE, f1.fileno())
+    return True
+
+def _store_by_hardlink(src: str, dest: str) -> bool:
+    mode = os.stat(src).st_mode
+    if mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        # the source could be modified, which would also modify the stored file
+        return False
+    os.link(src, dest)
+    return True
+
+def _store_by_copy_file_range(src: str, dest: str) -> bool:
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    with open(src, 'rb') as f1, open(dest, 'wb') as f2:
+        remaining = os.fstat(f1.fileno()).st_size
+        while remaining > 0:
+            n = os.copy_file_range(f1.fileno(), f2.fileno(), min(remaining, 1024 * 1024 * 1024))
+            if n == 0:
+                break
+            remaining -= n
+    return remaining == 0
+
+def _store_by_copy(src: str, dest: str) -> bool:
+    # on Linux, shutil.copyfile uses sendfile
+    shutil.copyfile(src, dest)
+    return True
+
+_store_methods = {
+    'reflink': _store_by_reflink,
+    'hardlink': _store_by_hardlink,
+    'copy_file_range': _store_by_copy_file_range,
+    'copy': _store_by_copy
+}
 
 def _local_kachery_storage_link_file(*, path: str, _no_manifest=False) -> Tuple[str, str, Union[str, None]]:
     from ._store_file import _store_json # don't want circular dependencies
@@ -103,6 +280,7 @@ def _local_kachery_storage_link_file(*, path: str, _no_manifest=False) -> Tuple[
                 }
             }, f)
         _rename_file(tmp_path, path0 + '.link', remove_if_exists=True)
+        _add_to_local_storage_index(hash0, is_link=True)
     return path0, hash0, manifest_hash
 
 def _get_file_hash(path: str, *, _cache_only=False):
@@ -120,13 +298,19 @@ def _get_file_hash(path: str, *, _cache_only=False):
             # in that case we don't need to compute
             return basename
 
+    cached = _get_cached_file_hash(path)
+    if cached is not None:
+        return cached['sha1']
+
     if _cache_only:
         return None
+    stat0 = os.stat(path)
     hash1 = _compute_file_hash(path, algorithm=algorithm)
     
     if not hash1:
         return None
 
+    _set_cached_file_hash(path, stat=stat0, sha1=hash1)
     return hash1
 
 def _compute_file_hash(path: str, algorithm: str) -> Optional[str]:
@@ -186,6 +370,25 @@ def _load_bytes_from_local_file(local_fname: str, *, start: Union[int, None]=Non
         else:
             return f.read(end-start)
 
+def _memoryview_of_local_file(local_fname: str, *, start: Union[int, None]=None, end: Union[int, None]=None) -> memoryview:
+    # Return a read-only, zero-copy view of a byte range of a file by memory-mapping it.
+    # Files in the kachery storage are immutable, so processes on the same
+    # machine can share the page cache for the same file.
+    size0 = os.path.getsize(local_fname)
+    if start is None:
+        start = 0
+    if end is None:
+        end = size0
+    if start < 0 or start > size0 or end < start or end > size0:
+        raise Exception('Invalid start/end range for file of size {}: {} - {}'.format(size0, start, end))
+    if size0 == 0:
+        # cannot mmap an empty file
+        return memoryview(bytes())
+    with open(local_fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # the memoryview keeps the mapping alive
+    return memoryview(mm)[start:end]
+
 def _rename_file(path1: str, path2: str, remove_if_exists: bool) -> None:
     if os.path.abspath(path1) == os.path.abspath(path2):
         return
@@ -219,39 +422,100 @@ def _compute_local_file_sha1_and_manifest(path):
     }
     if not os.path.exists(path):
         return None, None
-    size0 = os.path.getsize(path)
+    cached = _get_cached_file_hash(path)
+    if cached is not None and cached['manifest'] is not None:
+        return cached['sha1'], cached['manifest']
+    stat0 = os.stat(path)
+    size0 = stat0.st_size
     if (size0 > 1024 * 1024 * 100):
         print('Computing {} and manifest of {}'.format(algorithm, path))
 
     chunk_size = 20000000
 
+    # This is pipelined: a reader thread reads the chunks ahead into a bounded
+    # queue, the chunk hashes are computed in a thread pool, and the hash of
+    # the whole file (which is inherently serial) is updated in order on this
+    # thread. hashlib releases the GIL, so these run on separate cores.
+    chunk_queue: queue.Queue = queue.Queue(maxsize=_MANIFEST_NUM_CHUNKS_READ_AHEAD)
+    # set if the consumer stops early (e.g., on error), so that the reader does not block forever
+    stop_reading = threading.Event()
+    def put(item) -> bool:
+        while not stop_reading.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def read_chunks():
+        try:
+            with open(path, 'rb') as file:
+                pos = 0
+                while pos < size0:
+                    this_chunk_size = min(chunk_size, size0 - pos)
+                    buf = file.read(this_chunk_size)
+                    if len(buf) != this_chunk_size:
+                        raise Exception(f'Unexpected problem reading file (size changed?): {path}')
+                    if not put((pos, buf)):
+                        return
+                    pos = pos + this_chunk_size
+            put(None)
+        except Exception as e:
+            put(e)
+    reader = threading.Thread(target=read_chunks, daemon=True)
+    reader.start()
+
     hashsum = getattr(hashlib, algorithm)()
-    with open(path, 'rb') as file:
-        pos = 0
-        while pos < size0:
-            
-            this_chunk_size = min(chunk_size, size0 - pos)
+    chunk_hash_futures = []
+    pending_futures: Deque[Future] = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=_MANIFEST_NUM_HASH_WORKERS) as executor:
+            while True:
+                x = chunk_queue.get()
+                if x is None:
+                    break
+                if isinstance(x, Exception):
+                    raise x
+                pos, buf = x
+                # bound the number of chunks held in memory by pending hash computations
+                while len(pending_futures) >= 2 * _MANIFEST_NUM_HASH_WORKERS:
+                    pending_futures.popleft().result()
+                future = executor.submit(_compute_hash_of_bytes, buf, algorithm=algorithm)
+                chunk_hash_futures.append((pos, len(buf), future))
+                pending_futures.append(future)
+                hashsum.update(buf)
+    finally:
+        stop_reading.set()
+        # release any chunks that were read ahead
+        while True:
+            try:
+                chunk_queue.get_nowait()
+            except queue.Empty:
+                break
+        reader.join()
 
-            this_chunk_hashsum = getattr(hashlib, algorithm)()
-            buf = file.read(this_chunk_size)
-            this_chunk_hashsum.update(buf)
-            
-            hashsum.update(buf)
-            
-            chunk = {
-                'start': pos,
-                'end': pos + this_chunk_size,
-                'sha1': this_chunk_hashsum.hexdigest()
-            }
-            manifest['chunks'].append(chunk)
-            
-            pos = pos + this_chunk_size
+    for pos, this_chunk_size, future in chunk_hash_futures:
+        chunk = {
+            'start': pos,
+            'end': pos + this_chunk_size,
+            'sha1': future.result()
+        }
+        manifest['chunks'].append(chunk)
             
     sha1 = hashsum.hexdigest()
     manifest['sha1'] = sha1
     manifest['size'] = size0
+    _set_cached_file_hash(path, stat=stat0, sha1=sha1, manifest=manifest)
     return sha1, manifest
 
+_MANIFEST_NUM_CHUNKS_READ_AHEAD = 2
+_MANIFEST_NUM_HASH_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+
+def _compute_hash_of_bytes(buf: bytes, *, algorithm: str) -> str:
+    hashsum = getattr(hashlib, algorithm)()
+    hashsum.update(buf)
+    return hashsum.hexdigest()
+
 def _random_string(num_chars: int) -> str:
     chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
     return ''.join(random.choice(chars) for _ in range(num_chars))
\ No newline at end of file
@@ -2,7 +2,9 @@ import os
 import re
 import time
 import json
-from typing import Any, Dict, Iterable, Optional, Tuple, Union
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple, Union
 from urllib.parse import parse_qs
 
 def _parse_string_to_protocol_and_basename(string: str) -> Union[Tuple[str, str], None]:
@@ -57,17 +59,48 @@ def _parse_kachery_uri(uri: str) -> Tuple[str, str, str, str, dict]:
         raise Exception('Unexpected protocol: {}'.format(protocol))
     return protocol, algorithm, hash0, additional_path, query
 
+_http_session_data: Dict[str, Any] = {
+    'session': None,
+    'pid': None
+}
+_http_session_lock = threading.Lock()
+
+def _get_http_session():
+    # A single requests session shared by all threads, so that connections
+    # (e.g., to the daemon) are kept alive and reused between calls.
+    # The pool size can be set with the KACHERY_HTTP_POOL_SIZE environment variable.
+    try:
+        import requests
+        from requests.adapters import HTTPAdapter
+    except:
+        raise Exception('Error importing requests *')
+    pid = os.getpid()
+    with _http_session_lock:
+        if (_http_session_data['session'] is None) or (_http_session_data['pid'] != pid):
+            # connections cannot be shared with a forked process, so we create a new session there
+            pool_size = int(os.getenv('KACHERY_HTTP_POOL_SIZE', '10'))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session_data['session'] = session
+            _http_session_data['pid'] = pid
+        return _http_session_data['session']
+
+def _http_timeout() -> Tuple[float, Union[float, None]]:
+    # (connect timeout, read timeout) in seconds
+    # By default there is no read timeout because some daemon calls are long polls
+    connect_timeout = float(os.getenv('KACHERY_HTTP_CONNECT_TIMEOUT', '10'))
+    read_timeout = os.getenv('KACHERY_HTTP_READ_TIMEOUT', None)
+    return connect_timeout, (float(read_timeout) if read_timeout else None)
+
 def _http_post_json(url: str, data: dict, verbose: Optional[bool] = None, headers: dict = {}) -> dict:
     timer = time.time()
     if verbose is None:
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
         print('_http_post_json::: ' + url)
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests *')
-    req = requests.post(url, json=data, headers=headers)
+    req = _get_http_session().post(url, json=data, headers=headers, timeout=_http_timeout())
     try:
         if req.status_code != 200:
             return dict(
@@ -87,46 +120,70 @@ def _http_post_json_receive_json_socket(url: str, data: dict, verbose: Optional[
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
         print('_http_post_json::: ' + url)
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests *')
-    req = requests.post(url, json=data, stream=True, headers=headers)
+    req = _get_http_session().post(url, json=data, stream=True, headers=headers, timeout=_http_timeout())
     if req.status_code != 200:
         raise Exception('Error posting json: {} {}'.format(req.status_code, req.content.decode('utf-8')))
     class custom_iterator:
         def __init__(self):
-            pass
+            self._decoder = _JsonFrameDecoder()
+            # with stream=True and chunk_size=None, blocks are yielded as they arrive
+            self._blocks = req.iter_content(chunk_size=None)
+            self._messages: Deque[Any] = deque()
 
         def __iter__(self):
             return self
 
         def __next__(self):
-            buf = bytearray(b'')
-            while True:
-                c = req.raw.read(1)
-                if len(c) == 0:
+            while len(self._messages) == 0:
+                data = next(self._blocks, None)
+                if data is None:
                     raise StopIteration
-                if c == b'#':
-                    size = int(buf)
-                    x = req.raw.read(size)
-                    obj = json.loads(x)
-                    return obj
-                else:
-                    buf.append(c[0])
+                self._messages.extend(self._decoder.feed(data))
+            return self._messages.popleft()
     return custom_iterator(), req
 
+class _JsonFrameDecoder:
+    """Incremental decoder for the framed JSON messages streamed by the daemon
+
+    Each message is encoded as <size>#<json>, where size is the number of bytes
+    of the json. Data may be fed in blocks of any size (independent of the
+    message boundaries), so the decoder can be used with any transport,
+    synchronous or asynchronous.
+    """
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data: bytes) -> List[Any]:
+        """Add a block of data and return the list of messages that have been completed"""
+        buf = self._buf
+        buf.extend(data)
+        messages: List[Any] = []
+        pos = 0
+        while True:
+            ii = buf.find(b'#', pos)
+            if ii < 0:
+                break
+            size = int(buf[pos:ii])
+            if len(buf) < ii + 1 + size:
+                break
+            messages.append(json.loads(buf[ii + 1:ii + 1 + size]))
+            pos = ii + 1 + size
+        if pos > 0:
+            del buf[:pos]
+        return messages
+
+    @property
+    def num_pending_bytes(self) -> int:
+        """The number of bytes belonging to a message that is not yet complete"""
+        return len(self._buf)
+
 def _http_get_json(url: str, verbose: Optional[bool] = None, headers: dict = {}) -> dict:
     timer = time.time()
     if verbose is None:
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
         print('_http_get_json::: ' + url)
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests *')
-    req = requests.get(url, headers=headers)
+    req = _get_http_session().get(url, headers=headers, timeout=_http_timeout())
     try:
         if req.status_code != 200:
             return dict(
@@ -141,12 +198,8 @@ def _http_get_json(url: str, verbose: Optional[bool] = None, headers: dict = {})
         req.close()
 
 def _http_post_file(url: str, file_path: str, headers: dict = {}) -> dict:
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests *')
     with open(file_path, 'rb') as f:
-        req = requests.post(url, data=f, headers=headers)
+        req = _get_http_session().post(url, data=f, headers=headers, timeout=_http_timeout())
     try:
         if req.status_code != 200:
             raise Exception(f'Error posting file: {url} {file_path}')
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+from ._daemon_connection import _kachery_temp_dir, _create_if_needed
+from ._local_kachery_storage import _random_string
+
+# Local cache of byte ranges of remote files, so that windowed reads of large
+# files do not require downloading the whole file (or whole manifest chunks),
+# and repeated reads of the same window are served from disk.
+#
+# For each file (identified by sha1) there is a small JSON sidecar
+# ({sha1}.blocks) with the file size and a bitmap of which fixed-size blocks
+# have been fetched, and a sparse data file ({sha1}.{generation}.data). Ranges
+# are fetched in whole blocks. The data is always written before the bitmap is
+# updated, so a block is never marked as present before its bytes are on disk.
+# If two processes update the bitmap of the same file at the same time, one of
+# the updates may be lost, which only means that those blocks will be fetched
+# again.
+#
+# The total size of the cache is kept under a quota by evicting the least
+# recently used files (the sidecar is touched on each read). The generation
+# in the name of the data file ensures that a reader never combines a bitmap
+# with a data file that was evicted and recreated in the meantime: a data file
+# is only ever created together with a new generation, and an open data file
+# remains readable after it is evicted.
+
+_SPARSE_FILE_CACHE_BLOCK_SIZE = 1024 * 1024
+
+# data files that do not belong to the current generation are removed after this long
+_ORPHANED_DATA_FILE_MAX_AGE_SEC = 3600
+
+# fetch(start, end) returns (bytes, total size of file) or None if not found
+_FetchFunction = Callable[[int, int], Union[Tuple[bytes, int], None]]
+
+class _SparseFileCache:
+    def __init__(self, directory: str, *, max_bytes: int, block_size: int=_SPARSE_FILE_CACHE_BLOCK_SIZE):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._block_size = block_size
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        # estimate of the size of the cache on disk (None until the first scan)
+        self._num_bytes: Union[int, None] = None
+        self._eviction_lock = threading.Lock()
+    def read(self, sha1: str, *, start: int, end: int, size: Union[int, None], fetch: Union[_FetchFunction, None]) -> Union[bytes, None]:
+        """Read bytes [start, end) of the file, fetching the blocks that are not yet cached.
+
+        The size may be None if not known. If fetch is None, or if the file was
+        not found by fetch, None is returned unless all of the blocks are cached.
+        """
+        with self._lock_for(sha1):
+            info_path = self._info_path(sha1)
+            info = _read_info(info_path)
+            f = None
+            if info is not None and info['blockSize'] == self._block_size:
+                try:
+                    f = open(self._data_path(sha1, info['generation']), 'r+b')
+                except FileNotFoundError:
+                    # evicted
+                    pass
+            if f is None:
+                if fetch is None:
+                    return None
+                # the data file of the new generation is only created once
+                # something was fetched, so that nothing is left behind if
+                # the file is not found
+                info = {'size': size, 'blockSize': self._block_size, 'generation': _random_string(8), 'blocks': bytearray()}
+            try:
+                if size is None:
+                    size = info['size']
+                if size is not None:
+                    _check_range(start, end, size)
+                if start == end:
+                    return bytes()
+                B = self._block_size
+                num_bytes_fetched = 0
+                for block_start, block_end in _missing_block_runs(info['blocks'], start // B, (end - 1) // B + 1):
+                    if fetch is None:
+                        return None
+                    fetch_start = block_start * B
+                    fetch_end = block_end * B if size is None else min(size, block_end * B)
+                    a = fetch(fetch_start, fetch_end)
+                    if a is None:
+                        return None
+                    data, total_size = a
+                    if size is None:
+                        size = total_size
+                        _check_range(start, end, size)
+                        info['size'] = size
+                        fetch_end = min(fetch_end, size)
+                    elif total_size != size:
+                        raise Exception(f'Unexpected size of remote file {sha1}: {total_size} <> {size}')
+                    if len(data) != fetch_end - fetch_start:
+                        raise Exception(f'Unexpected number of bytes fetched for {sha1}: {len(data)} <> {fetch_end - fetch_start}')
+                    if f is None:
+                        os.makedirs(os.path.dirname(info_path), exist_ok=True)
+                        f = open(self._data_path(sha1, info['generation']), 'w+b')
+                    f.seek(fetch_start)
+                    f.write(data)
+                    f.flush()
+                    # the data must be on disk before the bitmap says that it is
+                    os.fsync(f.fileno())
+                    _set_blocks(info['blocks'], block_start, block_end)
+                    num_bytes_fetched += len(data)
+                if num_bytes_fetched > 0:
+                    _write_info(info_path, info)
+                else:
+                    # for least-recently-used eviction
+                    _touch(info_path)
+                f.seek(start)
+                ret = f.read(end - start)
+            finally:
+                if f is not None:
+                    f.close()
+        if num_bytes_fetched > 0:
+            self._evict_if_needed(num_bytes_fetched)
+        return ret
+    def _evict_if_needed(self, num_bytes_added: int):
+        with self._eviction_lock:
+            if self._num_bytes is not None:
+                self._num_bytes += num_bytes_added
+                if self._num_bytes <= self._max_bytes:
+                    return
+            # other processes may also be adding to (or evicting from) the cache, so we rescan
+            self._num_bytes = _evict_least_recently_used(self._directory, max_bytes=self._max_bytes)
+    def _info_path(self, sha1: str):
+        return f'{self._directory}/{sha1[0:2]}/{sha1}.blocks'
+    def _data_path(self, sha1: str, generation: str):
+        return f'{self._directory}/{sha1[0:2]}/{sha1}.{generation}.data'
+    def _lock_for(self, sha1: str) -> threading.Lock:
+        with self._locks_lock:
+            if sha1 not in self._locks:
+                self._locks[sha1] = threading.Lock()
+            return self._locks[sha1]
+
+def _evict_least_recently_used(directory: str, *, max_bytes: int) -> int:
+    # Remove the least recently used files until the cache is below 90% of the
+    # quota and return the resulting size of the cache
+    entries: List[Tuple[float, str, List[str], int]] = [] # (last access time, info path, data paths, size)
+    num_bytes = 0
+    now = time.time()
+    for subdir in _list_dir(directory):
+        if not os.path.isdir(subdir):
+            continue
+        data_paths_by_sha1: Dict[str, List[str]] = {}
+        info_paths: List[str] = []
+        for p in _list_dir(subdir):
+            name = os.path.basename(p)
+            if name.endswith('.data'):
+                data_paths_by_sha1.setdefault(name.split('.')[0], []).append(p)
+            elif name.endswith('.blocks'):
+                info_paths.append(p)
+            elif '.blocks.' in name and _age(p, now) > _ORPHANED_DATA_FILE_MAX_AGE_SEC:
+                # left behind by an interrupted write of a sidecar
+                _remove_file(p)
+        for info_path in info_paths:
+            sha1 = os.path.basename(info_path).split('.')[0]
+            info = _read_info(info_path)
+            current_data_path = f'{subdir}/{sha1}.{info["generation"]}.data' if info is not None else None
+            data_paths = data_paths_by_sha1.pop(sha1, [])
+            for p in list(data_paths):
+                if p != current_data_path and _age(p, now) > _ORPHANED_DATA_FILE_MAX_AGE_SEC:
+                    _remove_file(p)
+                    data_paths.remove(p)
+            size = sum([_disk_usage(p) for p in data_paths])
+            num_bytes += size
+            try:
+                last_access_time = os.stat(info_path).st_mtime
+            except OSError:
+                continue
+            entries.append((last_access_time, info_path, data_paths, size))
+        for data_paths in data_paths_by_sha1.values():
+            # data files without a sidecar
+            for p in data_paths:
+                if _age(p, now) > _ORPHANED_DATA_FILE_MAX_AGE_SEC:
+                    _remove_file(p)
+                else:
+                    num_bytes += _disk_usage(p)
+    if num_bytes <= max_bytes:
+        return num_bytes
+    entries.sort()
+    for last_access_time, info_path, data_paths, size in entries:
+        if num_bytes <= 0.9 * max_bytes:
+            break
+        # remove the sidecar first, so that no new readers use the data file
+        _remove_file(info_path)
+        for p in data_paths:
+            _remove_file(p)
+        num_bytes -= size
+    return num_bytes
+
+def _list_dir(dirpath: str) -> List[str]:
+    try:
+        return [e.path for e in os.scandir(dirpath)]
+    except OSError:
+        return []
+
+def _disk_usage(path: str) -> int:
+    # the actual space used by the (sparse) file
+    try:
+        s = os.stat(path)
+    except OSError:
+        return 0
+    if hasattr(s, 'st_blocks'):
+        return s.st_blocks * 512
+    return s.st_size
+
+def _age(path: str, now: float) -> float:
+    try:
+        return now - os.stat(path).st_mtime
+    except OSError:
+        return 0
+
+def _remove_file(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        # maybe it was removed by someone else
+        pass
+
+def _touch(path: str):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _check_range(start: int, end: int, size: int):
+    if start < 0 or start > size or end < start or end > size:
+        raise Exception('Invalid start/end range for file of size {}: {} - {}'.format(size, start, end))
+
+def _missing_block_runs(blocks: bytearray, b0: int, b1: int) -> List[Tuple[int, int]]:
+    # contiguous runs [start, end) of blocks in [b0, b1) that are not present
+    runs: List[Tuple[int, int]] = []
+    for b in range(b0, b1):
+        if not _has_block(blocks, b):
+            if len(runs) > 0 and runs[-1][1] == b:
+                runs[-1] = (runs[-1][0], b + 1)
+            else:
+                runs.append((b, b + 1))
+    return runs
+
+def _has_block(blocks: bytearray, b: int) -> bool:
+    return (b // 8 < len(blocks)) and ((blocks[b // 8] >> (b % 8)) & 1) == 1
+
+def _set_blocks(blocks: bytearray, b0: int, b1: int):
+    n = (b1 + 7) // 8
+    if len(blocks) < n:
+        blocks.extend(bytes(n - len(blocks)))
+    for b in range(b0, b1):
+        blocks[b // 8] |= 1 << (b % 8)
+
+def _read_info(info_path: str) -> Union[dict, None]:
+    try:
+        with open(info_path, 'r') as f:
+            x = json.load(f)
+        return {'size': x['size'], 'blockSize': x['blockSize'], 'generation': x['generation'], 'blocks': bytearray.fromhex(x['blocks'])}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _write_info(info_path: str, info: dict):
+    tmp_path = info_path + '.' + _random_string(6)
+    with open(tmp_path, 'w') as f:
+        json.dump({'size': info['size'], 'blockSize': info['blockSize'], 'generation': info['generation'], 'blocks': info['blocks'].hex()}, f)
+    # atomic, so that readers never see a missing sidecar
+    os.replace(tmp_path, info_path)
+
+def _sparse_file_cache_max_bytes() -> int:
+    return int(float(os.getenv('KACHERY_SPARSE_FILE_CACHE_QUOTA_GB', 10)) * 1e9)
+
+_global: Dict[str, Union[_SparseFileCache, None]] = {
+    'sparse_file_cache': None
+}
+
+def _get_sparse_file_cache() -> _SparseFileCache:
+    x = _global['sparse_file_cache']
+    if x is None:
+        x = _SparseFileCache(_create_if_needed(f'{_kachery_temp_dir()}/sparse-file-cache'), max_bytes=_sparse_file_cache_max_bytes())
+        _global['sparse_file_cache'] = x
+    return x
@@ -1,17 +1,19 @@
 import os
-from typing import Any, Union
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Union
 import simplejson
 import numpy as np
 import stat
 import json
 
 from ._daemon_connection import _kachery_storage_dir, _daemon_url, _connected_to_daemon
-from ._local_kachery_storage import _local_kachery_storage_store_file, _local_kachery_storage_link_file
+from ._local_kachery_storage import _local_kachery_storage_link_file
 from ._misc import _http_post_json, _http_post_file
 from ._temporarydirectory import TemporaryDirectory
 from ._safe_pickle import _safe_pickle, _safe_unpickle
-from ._local_kachery_storage import _get_path_ext
+from ._local_kachery_storage import _get_path_ext, _get_file_hash, _find_linked_file
+from ._file_hash_cache import _get_cached_file_hash, _set_cached_file_hash
+from .local_storage_index import _add_to_local_storage_index
 from .enable_ephemeral import _use_ephemeral
 
 _global = {
@@ -33,7 +35,12 @@ def _store_file(path: str, basename: Union[str, None]=None) -> str:
         return _get_direct_client().store_file(path, basename=basename)
     if not _connected_to_daemon():
         raise Exception('Not connected to daemon and not in ephemeral mode.')
-    file_size = os.path.getsize(path)
+    stat0 = os.stat(path)
+    file_size = stat0.st_size
+    # if this file was stored before and has not changed since, there is no need to send it again
+    uri0 = _uri_from_cached_file_hash(path, basename=basename, linked_ok=False)
+    if uri0 is not None:
+        return uri0
     daemon_url, headers = _daemon_url()
     # url = f'{daemon_url}/storeFile'
     url = f'{daemon_url}/store'
@@ -46,6 +53,16 @@ def _store_file(path: str, basename: Union[str, None]=None) -> str:
     sha1 = resp['sha1']
     manifest_sha1 = resp['manifestSha1']
 
+    _check_stored_file(sha1=sha1, file_size=file_size, path=path)
+
+    _set_cached_file_hash(path, stat=stat0, sha1=sha1, manifest_sha1=manifest_sha1 or None)
+
+    if manifest_sha1:
+        return f'sha1://{sha1}/{basename}?manifest={manifest_sha1}'
+    else:
+        return f'sha1://{sha1}/{basename}'
+
+def _check_stored_file(*, sha1: str, file_size: int, path: str) -> None:
     # important to verify that we can access the file
     # this is crucial for systems where the daemon is running on a different computer
     # in frank lab there was an issue where we needed to stat the file before proceeding
@@ -54,26 +71,50 @@ def _store_file(path: str, basename: Union[str, None]=None) -> str:
     if not os.path.exists(path0):
         raise Exception(f'Unexpected, could not find stored file after storing with daemon: {path0}')
 
-    size0 = _get_file_size_using_system_call(path0)
+    size0 = os.stat(path0).st_size
     if size0 != file_size:
         if size0 == 0:
             # perhaps the file has not synced across devices
             raise Exception(f'Inconsistent size between stored file and original file for: {path} {path0} {file_size} {size0}')
         else:
             raise Exception(f'Unexpected size discrepancy between stored file and original file for: {path} {path0} {file_size} {size0}')
+    _add_to_local_storage_index(sha1, is_link=False)
 
-    if manifest_sha1:
-        return f'sha1://{sha1}/{basename}?manifest={manifest_sha1}'
-    else:
-        return f'sha1://{sha1}/{basename}'
+def _store_files(paths: List[str], *, max_concurrency: int=4) -> List[str]:
+    if _use_ephemeral():
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            return list(executor.map(_store_file, paths))
+    if not _connected_to_daemon():
+        raise Exception('Not connected to daemon and not in ephemeral mode.')
+    sha1_directory = f'{_kachery_storage_dir()}/sha1'
+    def store(path: str) -> str:
+        basename = os.path.basename(path)
+        # files larger than this are stored with a manifest by the daemon, and
+        # the manifest hash is needed for the URI, so we always send those to the daemon
+        if os.path.getsize(path) <= 20000000:
+            sha1 = _get_file_hash(path)
+            if sha1 is not None:
+                path0 = _get_path_ext(hash=sha1, create=False, directory=sha1_directory)
+                if os.path.exists(path0):
+                    # already stored
+                    return f'sha1://{sha1}/{basename}'
+        return _store_file(path, basename=basename)
+    # hash the files and send the ones that are not already stored to the daemon, using a pool of workers
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        return list(executor.map(store, paths))
 
 def _link_file(path: str, basename: Union[str, None]=None) -> str:
     if basename is None:
         basename = os.path.basename(path)
     if not _connected_to_daemon():
         raise Exception('Not connected to daemon (*).')
-    file_size = os.path.getsize(path)
-    mtime = os.stat(path).st_mtime
+    stat0 = os.stat(path)
+    file_size = stat0.st_size
+    mtime = stat0.st_mtime
+    # if this file was linked (or stored) before and has not changed since, there is no need for the daemon to hash it again
+    uri0 = _uri_from_cached_file_hash(path, basename=basename, linked_ok=True)
+    if uri0 is not None:
+        return uri0
     daemon_url, headers = _daemon_url()
     url = f'{daemon_url}/linkFile'
     resp = _http_post_json(url, {'localFilePath': os.path.abspath(path), 'size': file_size, 'mtime': mtime}, headers=headers)
@@ -92,31 +133,54 @@ def _link_file(path: str, basename: Union[str, None]=None) -> str:
         raise Exception(f'Unexpected, could not find stored file after linking with daemon: {path0}')
 
     if os.path.exists(path0):
-        size0 = _get_file_size_using_system_call(path0)
+        size0 = os.stat(path0).st_size
         if size0 != file_size:
             if size0 == 0:
                 # perhaps the file has not synced across devices
                 raise Exception(f'Inconsistent size between stored/linked file and original file for: {path} {path0} {file_size} {size0}')
             else:
                 raise Exception(f'Unexpected size discrepancy between stored/linked file and original file for: {path} {path0} {file_size} {size0}')
+        _add_to_local_storage_index(sha1, is_link=False)
     else:
         try:
             with open(path0 + '.link', 'r') as f:
                 json.load(f)
         except:
             raise Exception(f'Unexpected file reading link file after linking: {path}')
+        _add_to_local_storage_index(sha1, is_link=True)
+
+    _set_cached_file_hash(path, stat=stat0, sha1=sha1, manifest_sha1=manifest_sha1 or None)
 
     if manifest_sha1:
         return f'sha1://{sha1}/{basename}?manifest={manifest_sha1}'
     else:
         return f'sha1://{sha1}/{basename}'
 
-def _get_file_size_using_system_call(path: str):
-    import sys
-    if sys.platform == 'darwin':
-        return int(subprocess.check_output(['stat', '-f', '%z', path]))
+def _uri_from_cached_file_hash(path: str, *, basename: str, linked_ok: bool) -> Union[str, None]:
+    # Return the URI of a file that is already stored (or linked, if linked_ok)
+    # in the local kachery storage, using the file hash cache, or None if the
+    # file is not known to be stored.
+    cached = _get_cached_file_hash(path)
+    if cached is None:
+        return None
+    sha1 = cached['sha1']
+    manifest_sha1 = cached['manifest_sha1']
+    if (manifest_sha1 is None) and (os.path.getsize(path) > 20000000):
+        # the daemon would create a manifest for this file, and we need its hash for the URI
+        return None
+    sha1_directory = f'{_kachery_storage_dir()}/sha1'
+    path0 = _get_path_ext(hash=sha1, create=False, directory=sha1_directory)
+    if not os.path.exists(path0):
+        if not linked_ok:
+            return None
+        if not os.path.exists(path0 + '.link'):
+            return None
+        if _find_linked_file(path0 + '.link') != os.path.abspath(path):
+            return None
+    if manifest_sha1:
+        return f'sha1://{sha1}/{basename}?manifest={manifest_sha1}'
     else:
-        return int(subprocess.check_output(['stat', '-c%s', path]))
+        return f'sha1://{sha1}/{basename}'
 
 def _add_read_permissions(fname: str):
     st = os.stat(fname)
@@ -138,6 +202,18 @@ def _store_text(text: str, basename: Union[str, None]=None) -> str:
         _add_read_permissions(fname)
         return _store_file(fname, basename=basename)
 
+def _store_bytes(data: bytes, basename: Union[str, None]=None) -> str:
+    if basename is None:
+        basename = 'file.dat'
+    with TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/data.dat'
+        with open(fname, 'wb') as f:
+            f.write(data)
+        _add_read_permissions(tmpdir)
+        _add_exec_permissions(tmpdir)
+        _add_read_permissions(fname)
+        return _store_file(fname, basename=basename)
+
 def _store_json(object: Union[dict, list, int, float, str], basename: Union[str, None]=None, separators=(',', ':'), indent=None) -> str:
     if basename is None:
         basename = 'file.json'
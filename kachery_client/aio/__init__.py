@@ -0,0 +1,7 @@
+# Async (asyncio) versions of the kachery_client functions (requires aiohttp)
+from .main import load_file, load_json, load_text
+from .main import store_json, store_text
+from .main import get, set, delete
+from .main import watch_for_new_messages
+from .main import close
+from .request_task import request_task, OutgoingTaskRequest
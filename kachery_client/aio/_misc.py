@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import json
+import weakref
+from typing import Any, AsyncGenerator, Callable
+from .._misc import _JsonFrameDecoder, _http_timeout
+
+# one aiohttp session (connection pool) per event loop
+_http_sessions: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]' = weakref.WeakKeyDictionary()
+
+def _get_http_session():
+    try:
+        import aiohttp
+    except:
+        raise Exception('Error importing aiohttp (required for kachery_client.aio). Use pip install aiohttp.')
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop, None)
+    if (session is None) or session.closed:
+        connect_timeout, read_timeout = _http_timeout()
+        session = aiohttp.ClientSession(
+            # no limit on the number of connections, since many of the requests are long polls
+            connector=aiohttp.TCPConnector(limit=0),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        )
+        _http_sessions[loop] = session
+    return session
+
+async def _close_http_session():
+    session = _http_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+async def _run_blocking(func: Callable, *args, **kwargs):
+    # run a blocking function (e.g., probing the daemon or reading a large file) in the default executor
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+async def _http_post_json(url: str, data: dict, headers: dict = {}) -> dict:
+    async with _get_http_session().post(url, json=data, headers=headers) as resp:
+        content = await resp.read()
+        if resp.status != 200:
+            return dict(
+                success=False,
+                error='Error posting json: {} {}'.format(
+                    resp.status, content.decode('utf-8'))
+            )
+        return json.loads(content)
+
+async def _http_get_json(url: str, headers: dict = {}) -> dict:
+    async with _get_http_session().get(url, headers=headers) as resp:
+        content = await resp.read()
+        if resp.status != 200:
+            return dict(
+                success=False,
+                error='Error getting json: {} {}'.format(
+                    resp.status, content.decode('utf-8'))
+            )
+        return json.loads(content)
+
+async def _http_post_bytes(url: str, data: bytes, headers: dict = {}) -> dict:
+    async with _get_http_session().post(url, data=data, headers=headers) as resp:
+        content = await resp.read()
+        if resp.status != 200:
+            raise Exception(f'Error posting data: {url} {resp.status}')
+        return json.loads(content)
+
+async def _http_post_json_receive_json_socket(url: str, data: dict, headers: dict = {}) -> AsyncGenerator[Any, None]:
+    async with _get_http_session().post(url, json=data, headers=headers) as resp:
+        if resp.status != 200:
+            content = await resp.read()
+            raise Exception('Error posting json: {} {}'.format(resp.status, content.decode('utf-8')))
+        decoder = _JsonFrameDecoder()
+        async for block in resp.content.iter_any():
+            for msg in decoder.feed(block):
+                yield msg
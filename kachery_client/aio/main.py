@@ -0,0 +1,224 @@
+from typing import Any, Dict, Union
+import simplejson
+
+from .._daemon_connection import _daemon_url, _kachery_storage_dir, _connected_to_daemon, _offline_mode
+from .._load_file import _load_file, _load_file_from_local_kachery_storage, _create_load_file_request, _process_load_file_message
+from .._store_file import _store_text, _check_stored_file
+from .._feeds import _create_watch_for_new_messages_request
+from ..enable_ephemeral import _ephemeral_enabled
+from ._misc import _run_blocking, _http_post_json, _http_post_bytes, _http_post_json_receive_json_socket, _close_http_session
+
+async def load_file(
+    uri: str,
+    dest: Union[str, None]=None,
+    local_only: bool=False,
+    channel: Union[str, None]=None
+) -> Union[str, None]:
+    """Load a file either from local kachery storage or from a remote kachery node (async version of kachery_client.load_file)
+
+    Args:
+        uri (str): The kachery URI for the file to load: sha1://...
+        dest (Union[str, None], optional): Optional location to copy the file to. Defaults to None.
+        local_only (bool, optional): Optionally only load file from local kachery directory. Defaults to False.
+        channel (Union[str, None], optional): The kachery channel to download from. Defaults to None.
+
+    Returns:
+        Union[str, None]: If found, the local path of the loaded file, else None
+    """
+    if (not uri.startswith('sha1://')) or _ephemeral_enabled():
+        # local paths and ephemeral mode do not involve the daemon
+        return await _run_blocking(_load_file, uri, dest, local_only=local_only, channel=channel)
+
+    # first check the local kachery storage (if kachery storage dir is known)
+    if await _run_blocking(_kachery_storage_dir):
+        local_path = await _run_blocking(_load_file_from_local_kachery_storage, uri, dest=dest)
+        if local_path is not None:
+            return local_path
+    if _offline_mode():
+        # offline mode: only the local storage directory is used
+        return None
+    if not await _run_blocking(_connected_to_daemon):
+        raise Exception('Not connected to a kachery daemon and not in ephemeral mode.')
+
+    if local_only:
+        return None
+
+    if channel is None:
+        return None
+
+    daemon_url, headers = await _run_blocking(_daemon_url)
+    url = f'{daemon_url}/loadFile'
+    messages = _http_post_json_receive_json_socket(url, _create_load_file_request(uri, channel=channel), headers=headers)
+    try:
+        async for r in messages:
+            done, local_file_path = _process_load_file_message(r, uri)
+            if done:
+                return local_file_path
+        raise Exception(f'Unable to download file: {uri}')
+    finally:
+        await messages.aclose()
+
+async def load_json(uri: str, *, channel: Union[str, None]=None) -> Union[dict, None]:
+    """Load an object (Python dict) either from local kachery storage or from a remote kachery node (async version of kachery_client.load_json)
+
+    Args:
+        uri (str): The kachery URI for the file to load: sha1://...
+
+    Returns:
+        Union[dict, None]: If found, the Python dict, else None
+    """
+    local_path = await load_file(uri, channel=channel)
+    if local_path is None:
+        return None
+    return await _run_blocking(_read_json_file, local_path)
+
+async def load_text(uri: str, *, channel: Union[str, None]=None) -> Union[str, None]:
+    """Load a text string either from local kachery storage or from a remote kachery node (async version of kachery_client.load_text)
+
+    Args:
+        uri (str): The kachery URI for the file to load: sha1://...
+
+    Returns:
+        Union[str, None]: If found, the text string, else None
+    """
+    local_path = await load_file(uri, channel=channel)
+    if local_path is None:
+        return None
+    return await _run_blocking(_read_text_file, local_path)
+
+async def store_text(text: str, basename: Union[str, None]=None) -> str:
+    """Store text in the local kachery storage and return a kachery URI (async version of kachery_client.store_text)
+
+    Args:
+        text (str): The text string to store
+        basename (Union[str, None], optional): Optional base file name to append to the sha1:// URI. Defaults to None.
+
+    Returns:
+        str: The kachery URI: sha1://...
+    """
+    if basename is None:
+        basename = 'file.txt'
+    if _ephemeral_enabled():
+        return await _run_blocking(_store_text, text, basename=basename)
+    if not await _run_blocking(_connected_to_daemon):
+        raise Exception('Not connected to daemon and not in ephemeral mode.')
+    data = text.encode('utf-8')
+    daemon_url, headers = await _run_blocking(_daemon_url)
+    url = f'{daemon_url}/store'
+    headers['Content-Length'] = f'{len(data)}'
+    resp = await _http_post_bytes(url, data, headers=headers)
+    if not resp['success']:
+        raise Exception(f'Problem storing file: {resp["error"]}')
+    sha1 = resp['sha1']
+    manifest_sha1 = resp['manifestSha1']
+    await _run_blocking(_check_stored_file, sha1=sha1, file_size=len(data), path='<text>')
+    if manifest_sha1:
+        return f'sha1://{sha1}/{basename}?manifest={manifest_sha1}'
+    else:
+        return f'sha1://{sha1}/{basename}'
+
+async def store_json(object: Union[dict, list, int, float, str], basename: Union[str, None]=None) -> str:
+    """Store object (Python dict, list or other jsonable) in the local kachery storage and return a kachery URI (async version of kachery_client.store_json)
+
+    Args:
+        object (dict): The Python dict to store
+        basename (Union[str, None], optional): Optional base file name to append to the sha1:// URI. Defaults to None.
+
+    Returns:
+        str: The kachery URI: sha1://...
+    """
+    if basename is None:
+        basename = 'file.json'
+    txt = simplejson.dumps(object, separators=(',', ':'), indent=None, allow_nan=False)
+    return await store_text(text=txt, basename=basename)
+
+async def watch_for_new_messages(subfeed_watches: Dict[str, dict], *, wait_msec, channel: str='*local*', signed=False, max_num_messages=0) -> Dict[str, Any]:
+    """Watch for new messages on one or more subfeeds (async version of kachery_client.watch_for_new_messages)
+
+    Args:
+        subfeed_watches (Dict[str, dict]): The subfeed watches, by key
+        wait_msec ([type]): The wait duration for retrieving the messages
+
+    Returns:
+        Dict[str, Any]: The retrieved messages, by key
+    """
+    daemon_url, headers = await _run_blocking(_daemon_url)
+    url = f'{daemon_url}/feed/watchForNewMessages'
+    x = await _http_post_json(url, _create_watch_for_new_messages_request(
+        subfeed_watches, wait_msec=wait_msec, channel=channel, signed=signed, max_num_messages=max_num_messages
+    ), headers=headers)
+    if not x['success']:
+        raise Exception(f'Unable to watch for new messages: {x["error"]}')
+    return x['messages']
+
+async def set(key: Union[str, dict, list], value: Union[str, dict, list], update: bool=True) -> bool:
+    """Set a mutable value (only available locally) (async version of kachery_client.set)
+
+    Args:
+        key (Union[str, dict, list]): The key
+        value (Union[str, dict, list]): The value
+        update (bool): If False does not overwrite existing value, and returns False if new value was not set. Default is True.
+
+    Returns:
+        bool: whether the value was successfully set
+    """
+    daemon_url, headers = await _run_blocking(_daemon_url)
+    url = f'{daemon_url}/mutable/set'
+    req = {'key': key, 'value': value}
+    if update == False:
+        req['update'] = update # don't include update if True to be compatible with old daemon
+    x = await _http_post_json(url, req, headers=headers)
+    if 'success' not in x:
+        raise Exception(f'Unexpected problem setting value for key: {key}')
+    return x['success']
+
+async def get(key: Union[str, dict, list]):
+    """Get a mutable value (only available locally) (async version of kachery_client.get)
+
+    Args:
+        key (Union[str, dict, list]): The key
+
+    Returns:
+        value (Union[str, dict, list, None]): The value if found, else None
+    """
+    daemon_url, headers = await _run_blocking(_daemon_url)
+    url = f'{daemon_url}/mutable/get'
+    x = await _http_post_json(url, dict(
+        key=key
+    ), headers=headers)
+    if not x['success']:
+        raise Exception(f'Unable to get value for key: {key}')
+    if x['found']:
+        return x['value']
+    else:
+        return None
+
+async def delete(key: Union[str, dict, list]):
+    """Delete a mutable value (only available locally) (async version of kachery_client.delete)
+
+    Args:
+        key (Union[str, dict, list]): The key
+
+    Returns:
+        bool: whether the value was deleted
+    """
+    daemon_url, headers = await _run_blocking(_daemon_url)
+    url = f'{daemon_url}/mutable/delete'
+    x = await _http_post_json(url, dict(
+        key=key
+    ), headers=headers)
+    if 'success' not in x:
+        raise Exception(f'Unexpected problem deleting value for key: {key}')
+    return x['success']
+
+async def close() -> None:
+    """Close the HTTP connections used by kachery_client.aio in the running event loop"""
+    await _close_http_session()
+
+def _read_json_file(path: str):
+    with open(path, 'r') as f:
+        return simplejson.load(f)
+
+def _read_text_file(path: str):
+    with open(path, 'r') as f:
+        return f.read()
@@ -0,0 +1,82 @@
+from typing import Any, Union
+from .._daemon_connection import _daemon_url
+from ..request_task import _cache_bust
+from ._misc import _run_blocking, _http_post_json, _http_get_json
+
+class OutgoingTaskRequest:
+    """Async version of kachery_client.request_task.OutgoingTaskRequest"""
+    def __init__(self, *, channel: str, task_id: str, task_function_type: str, task_result_url: Union[str, None], status: str, error_message: Union[str, None]):
+        self._channel = channel
+        self._task_id = task_id
+        self._task_function_type = task_function_type
+        self._task_result_url = task_result_url
+        self._status = status
+        self._error_message = error_message
+        self._downloaded_result: Union[Any, None] = None
+    @property
+    def status(self):
+        return self._status
+    @property
+    def task_result_url(self):
+        return self._task_result_url
+    @property
+    def error_message(self):
+        return self._error_message
+    async def get_result(self):
+        if self._status != 'finished':
+            raise Exception('Cannot get task result if status is not finished')
+        if self._downloaded_result:
+            return self._downloaded_result
+        if not self._task_result_url:
+            raise Exception('No task result url')
+        url = self._task_result_url
+        if self._task_function_type != 'pure-calculation':
+            url = _cache_bust(url)
+        self._downloaded_result = await _http_get_json(url)
+        return self._downloaded_result
+    async def wait(self, timeout_sec: float):
+        if self._status not in ['finished', 'error']:
+            daemon_url, headers = await _run_blocking(_daemon_url)
+            url = f'{daemon_url}/task/waitForTaskResult'
+            req_data = {
+                'channelName': self._channel,
+                'taskId': self._task_id,
+                'taskResultUrl': self._task_result_url,
+                'taskFunctionType': self._task_function_type,
+                'timeoutMsec': timeout_sec * 1000
+            }
+            x = await _http_post_json(url, req_data, headers=headers)
+            if not x['success']:
+                print(x)
+                raise Exception(f'Unable to wait on task')
+            self._status = x['status']
+            self._error_message = x.get('errorMessage', None)
+        if self._status == 'error':
+            raise Exception(f'Task error: {self._error_message}')
+        if self._status == 'finished':
+            if self._task_function_type in ['pure-calculation', 'query']:
+                return await self.get_result()
+            elif self._task_function_type == 'action':
+                return True
+            else:
+                raise Exception(f'Unexpected function type: {self._task_function_type}')
+        return None
+
+async def request_task(*, task_function_id: str, task_kwargs: dict, task_function_type: str, channel: str) -> OutgoingTaskRequest:
+    daemon_url, headers = await _run_blocking(_daemon_url)
+    url = f'{daemon_url}/task/requestTask'
+    req_data = {
+        'channelName': channel,
+        'taskFunctionId': task_function_id,
+        'taskKwargs': task_kwargs,
+        'taskFunctionType': task_function_type,
+        'timeoutMsec': 1000
+    }
+    x = await _http_post_json(url, req_data, headers=headers)
+    if not x['success']:
+        raise Exception(f'Unable to load task result')
+    status = x['status']
+    task_id = x['taskId']
+    task_result_url = x.get('taskResultUrl', None)
+    error_message = x.get('errorMessage', None)
+    return OutgoingTaskRequest(channel=channel, task_id=task_id, task_function_type=task_function_type, task_result_url=task_result_url, status=status, error_message=error_message)
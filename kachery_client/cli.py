@@ -120,10 +120,24 @@ def cat_file(uri, start, end, channel: Union[str, None], direct_channel, enable_
         if start == end:
             return
         sys.stdout = old_stdout
-        if direct_channel is not None:
-            raise Exception('Cannot load byte range in direct mode. Not yet implemented.')
         kk.load_bytes(uri=uri, start=start, end=end, write_to_stdout=True)
 
+@click.command(help="Check all links in the local kachery storage and report those that are no longer valid.")
+@click.option('--max-concurrency', default=8, help='Number of links to check in parallel')
+def find_stale_links(max_concurrency: int):
+    x = kc.find_stale_links(max_concurrency=max_concurrency)
+    for a in x:
+        print(f'{a["link_path"]}\t{a["path"]}\t{a["problem"]}')
+    print(f'Found {len(x)} stale links', file=sys.stderr)
+
+@click.command(help="Evict least recently (or least frequently) used files from the ephemeral kachery storage.")
+@click.option('--max-size-gb', default=None, type=float, help='Maximum size of the storage in GB (defaults to KACHERY_EPHEMERAL_STORAGE_QUOTA_GB)')
+@click.option('--policy', default=None, type=click.Choice(['lru', 'lfu']), help='Eviction policy (defaults to KACHERY_EPHEMERAL_STORAGE_EVICTION_POLICY, or lru)')
+@click.option('--dry-run', is_flag=True, help='Only report what would be evicted')
+def gc(max_size_gb: Union[float, None], policy: Union[str, None], dry_run: bool):
+    x = kc.gc_ephemeral_storage(max_size_gb=max_size_gb, policy=policy, dry_run=dry_run)
+    print(f'{"Would evict" if dry_run else "Evicted"} {x["num_files_evicted"]} files ({x["num_bytes_evicted"]} bytes); {x["num_bytes_remaining"]} bytes remaining')
+
 @click.command(help='Configure an ephemeral node')
 def config_ephemeral_node():
     kc.config_ephemeral_node()
@@ -160,6 +174,8 @@ cli.add_command(cat_file)
 cli.add_command(load_file)
 cli.add_command(store_file)
 cli.add_command(link_file)
+cli.add_command(find_stale_links)
+cli.add_command(gc)
 cli.add_command(info)
 cli.add_command(version)
 cli.add_command(config_ephemeral_node)
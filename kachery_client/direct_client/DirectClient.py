@@ -1,12 +1,18 @@
 import os
+import sys
 import shutil
-from typing import Union, Any, List
+import hashlib
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Dict, Set, Tuple, Union, Any, List
 import numpy as np
 from .._misc import _http_post_json, _parse_kachery_uri, _get_kachery_hub_uri
 from .._temporarydirectory import TemporaryDirectory
 from ..main import store_file, load_file, store_npy, store_pkl, store_text, store_json
-from .._daemon_connection import _probe_daemon
-from .._local_kachery_storage import _compute_file_hash
+from .._daemon_connection import _probe_daemon, _kachery_temp_dir, _create_if_needed
+from .._local_kachery_storage import _compute_file_hash, _random_string, _rename_file, _copy_file_into_storage, _load_bytes_from_local_file
+from .._sparse_file_cache import _get_sparse_file_cache
+from .._ephemeral_storage_manager import _get_ephemeral_kachery_storage_dir, _record_ephemeral_storage_access
 from .._safe_pickle import _safe_unpickle, _safe_pickle
 
 
@@ -22,14 +28,18 @@ def _get_bucket_base_url(channel: str):
     return url
 
 class DirectClient:
-    def __init__(self, *, channel: Union[None, str]=None) -> None:
+    def __init__(self, *, channel: Union[None, str]=None, max_concurrency: int=4) -> None:
         self._channel = channel
+        # maximum number of manifest chunks to download in parallel
+        self._max_concurrency = max_concurrency
         # get the channel bucket base url within the constructor
         # so we can throw an exception right away if there is a problem
         if self._channel is not None:
             _get_bucket_base_url(self._channel)
         # check whether we are connected to a daemon
         self._connected_to_daemon = _probe_daemon() is not None
+        # files that we know are not stored in the bucket in their entirety
+        self._not_in_bucket: Set[str] = set()
     def load_file(
         self,
         uri: str,
@@ -50,6 +60,7 @@ class DirectClient:
             kachery_storage_file_name = f'{kachery_storage_parent_dir}/{sha1}'
             if os.path.exists(kachery_storage_file_name):
                 # we have the file locally... return that
+                _record_ephemeral_storage_access(sha1)
                 if dest:
                     shutil.copyfile(kachery_storage_file_name, dest)
                     return dest
@@ -62,70 +73,160 @@ class DirectClient:
                 return aa
             # The uri has a manifest, so we are going to load it in chunks
             manifest = self.load_json(f'sha1://{query["manifest"][0]}')
-            # load the file chunks individually
-            chunk_files = []
-            for chunk in manifest['chunks']:
-                chunk_sha1 = chunk['sha1']
-                chunk_start = chunk['start']
-                chunk_end = chunk['end']
-                chunk_fname = self.load_file(f'sha1://{chunk_sha1}?chunkOf={sha1}~{chunk_start}~{chunk_end}')
-                if chunk_fname is None:
-                    return None
-                chunk_files.append(chunk_fname)
+            # load the file chunks (in parallel)
+            chunk_files = self._load_manifest_chunks(sha1=sha1, manifest=manifest)
+            if chunk_files is None:
+                return None
             # we need to stitch the file together
-            with TemporaryDirectory() as tmpdir:
-                tmp_fname = f'{tmpdir}/concat.dat'
-                _concatenate_file_chunks(chunk_files, tmp_fname)
-                computed_sha1 = _compute_file_hash(tmp_fname, algorithm='sha1')
-                if computed_sha1 != sha1:
-                    raise Exception(f'Unexpected sha1 of concatenated file for {uri}')
-                if self._connected_to_daemon:
+            if self._connected_to_daemon:
+                with TemporaryDirectory() as tmpdir:
+                    tmp_fname = f'{tmpdir}/concat.dat'
+                    _assemble_file_from_chunks(chunk_files, tmp_fname, sha1=sha1)
                     a_uri = store_file(tmp_fname)
                     return load_file(a_uri, dest=dest)
+            else:
+                # stream the chunks directly into the ephemeral local kachery storage
+                if not os.path.exists(kachery_storage_parent_dir):
+                    os.makedirs(kachery_storage_parent_dir)
+                _assemble_file_from_chunks(chunk_files, kachery_storage_file_name, sha1=sha1)
+                _record_ephemeral_storage_access(sha1, added=True)
+                if dest:
+                    shutil.copyfile(kachery_storage_file_name, dest)
+                    return dest
                 else:
-                    if not os.path.exists(kachery_storage_parent_dir):
-                        os.makedirs(kachery_storage_parent_dir)
-                    shutil.copyfile(tmp_fname, kachery_storage_file_name)
-                    if dest:
-                        shutil.copyfile(kachery_storage_file_name, dest)
-                        return dest
-                    else:
-                        return kachery_storage_file_name
+                    return kachery_storage_file_name
         if self._channel is not None:
-            with TemporaryDirectory() as tmpdir:
-                url = _get_bucket_base_url(self._channel)
-                # download to this local file:
-                tmp_fname = f'{tmpdir}/file.dat'
-                # download from this url:
-                file_url = f'{url}/{self._channel}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
-                try:
-                    _http_get_file(file_url, tmp_fname)
-                except:
+            url = _get_bucket_base_url(self._channel)
+            # download from this url:
+            file_url = f'{url}/{self._channel}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
+            if self._connected_to_daemon:
+                # if we are connected to the daemon, download to the kachery temp dir
+                # and then store the file in the local kachery storage
+                download_dir = _create_if_needed(f'{_kachery_temp_dir()}/direct-client-downloads')
+                tmp_fname = f'{download_dir}/{sha1}'
+                # the temporary file is shared with other processes loading the same file
+                with _download_lock(tmp_fname):
+                    # another process may have stored the file while we were waiting
+                    local_path = load_file(uri, dest=dest, local_only=True)
+                    if local_path is not None:
+                        return local_path
+                    if not _download_file(file_url, tmp_fname, sha1=sha1):
+                        # if we didn't find the file in the bucket, return None
+                        return None
+                    try:
+                        store_file(tmp_fname)
+                    finally:
+                        os.unlink(tmp_fname)
+                return load_file(uri, dest=dest)
+            else:
+                # if we are not connected to daemon, download directly into the ephemeral local kachery storage
+                os.makedirs(kachery_storage_parent_dir, exist_ok=True)
+                if not _download_file(file_url, kachery_storage_file_name, sha1=sha1):
                     # if we didn't find the file in the bucket, return None
                     return None
-                # verify that we have the correct SHA1 hash
-                computed_sha1 = _compute_file_hash(tmp_fname, algorithm='sha1')
-                if computed_sha1 != sha1:
-                    raise Exception(f'Unexpected sha1 in downloaded file: {file_url}')
-
-                if self._connected_to_daemon:
-                    # if we are connected to the daemon, store the file in the local kachery storage
-                    store_file(tmp_fname)
-                    return load_file(uri, dest=dest)
+                _record_ephemeral_storage_access(sha1, added=True)
+                if dest:
+                    shutil.copyfile(kachery_storage_file_name, dest)
+                    return dest
                 else:
-                    # if we are not connected to daemon, store the file in the ephemeral local kachery storage
-                    if not os.path.exists(kachery_storage_parent_dir):
-                        os.makedirs(kachery_storage_parent_dir)
-                    shutil.copyfile(tmp_fname, kachery_storage_file_name)
-                    if dest:
-                        shutil.copyfile(kachery_storage_file_name, dest)
-                        return dest
-                    else:
-                        return kachery_storage_file_name
+                    return kachery_storage_file_name
         else:
             # self._channel is None
             return None
 
+    def _load_manifest_chunks(self, *, sha1: str, manifest: dict) -> Union[List[str], None]:
+        # Load the chunks of a file using a pool of workers. Chunks that are
+        # already in the local storage are found without downloading, and
+        # chunks with the same hash are only loaded once.
+        chunk_uris: List[str] = []
+        for chunk in manifest['chunks']:
+            chunk_sha1 = chunk['sha1']
+            chunk_start = chunk['start']
+            chunk_end = chunk['end']
+            chunk_uris.append(f'sha1://{chunk_sha1}?chunkOf={sha1}~{chunk_start}~{chunk_end}')
+        futures: Dict[str, Future] = {}
+        with ThreadPoolExecutor(max_workers=max(1, self._max_concurrency)) as executor:
+            for chunk_uri, chunk in zip(chunk_uris, manifest['chunks']):
+                if chunk['sha1'] not in futures:
+                    futures[chunk['sha1']] = executor.submit(self.load_file, chunk_uri)
+            try:
+                for future in as_completed(futures.values()):
+                    if future.result() is None:
+                        return None
+            finally:
+                # don't start any chunks that are still pending if we are bailing out
+                for future in futures.values():
+                    future.cancel()
+        return [futures[chunk['sha1']].result() for chunk in manifest['chunks']]
+
+    def load_bytes(self, uri: str, start: Union[int, None]=None, end: Union[int, None]=None, *, write_to_stdout: bool=False) -> Union[bytes, None]:
+        # Load a byte range of a file without downloading the whole file. The
+        # range is mapped onto the manifest chunks (if any) and only the
+        # blocks that are not already cached locally are fetched from the
+        # bucket using HTTP Range requests.
+        protocol, algorithm, sha1, additional_path, query = _parse_kachery_uri(uri)
+        assert algorithm == 'sha1'
+        if 'manifest' in query:
+            manifest = self.load_json(f'sha1://{query["manifest"][0]}')
+            if manifest is None:
+                return None
+            assert manifest['sha1'] == sha1, 'Manifest sha1 does not match expected.'
+            size = manifest['size']
+            if start is None:
+                start = 0
+            if end is None:
+                end = size
+            # first check whether the file is available in its entirety
+            data = self._load_bytes_of_object(sha1, start=start, end=end, size=size)
+            if data is None:
+                parts: List[bytes] = []
+                for ch in manifest['chunks']:
+                    if start < ch['end'] and end > ch['start']:
+                        part = self._load_bytes_of_object(ch['sha1'], start=max(start, ch['start']) - ch['start'], end=min(end, ch['end']) - ch['start'], size=ch['end'] - ch['start'])
+                        if part is None:
+                            return None
+                        parts.append(part)
+                data = b''.join(parts)
+        elif start is None or end is None:
+            # we need the size of the file, so we load the whole thing
+            local_path = self.load_file(uri)
+            if local_path is None:
+                return None
+            data = _load_bytes_from_local_file(local_path, start=start, end=end)
+        else:
+            data = self._load_bytes_of_object(sha1, start=start, end=end, size=None)
+        if data is None:
+            return None
+        if write_to_stdout:
+            sys.stdout.buffer.write(data)
+            return None
+        return data
+
+    def _load_bytes_of_object(self, sha1: str, *, start: int, end: int, size: Union[int, None]) -> Union[bytes, None]:
+        local_path = self._find_local_file(sha1)
+        if local_path is not None:
+            return _load_bytes_from_local_file(local_path, start=start, end=end)
+        if self._channel is None:
+            return None
+        if sha1 in self._not_in_bucket:
+            return None
+        url = _get_bucket_base_url(self._channel)
+        file_url = f'{url}/{self._channel}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
+        data = _get_sparse_file_cache().read(sha1, start=start, end=end, size=size, fetch=lambda a, b: _http_get_range(file_url, a, b))
+        if data is None:
+            self._not_in_bucket.add(sha1)
+        return data
+
+    def _find_local_file(self, sha1: str) -> Union[str, None]:
+        if self._connected_to_daemon:
+            return load_file(f'sha1://{sha1}', local_only=True)
+        kachery_storage_dir = _get_ephemeral_kachery_storage_dir()
+        kachery_storage_file_name = f'{kachery_storage_dir}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
+        if os.path.exists(kachery_storage_file_name):
+            _record_ephemeral_storage_access(sha1)
+            return kachery_storage_file_name
+        return None
+
     def load_json(self, uri: str) -> Union[dict, None]:
         import simplejson
         local_path = self.load_file(uri)
@@ -141,11 +242,14 @@ class DirectClient:
         with open(local_path, 'r') as f:
             return f.read()
 
-    def load_npy(self, uri: str) -> Union[np.ndarray, Any, None]:
+    def load_npy(self, uri: str, *, mmap_mode: Union[str, None]=None) -> Union[np.ndarray, Any, None]:
+        if mmap_mode not in [None, 'r', 'c']:
+            # files in kachery storage are immutable
+            raise Exception(f'Unsupported mmap_mode for load_npy: {mmap_mode}')
         local_path = self.load_file(uri)
         if local_path is None:
             return None
-        return np.load(local_path, allow_pickle=False)
+        return np.load(local_path, mmap_mode=mmap_mode, allow_pickle=False)
 
     def load_pkl(self, uri: str) -> Union[np.ndarray, None]:
         local_path = self.load_file(uri)
@@ -153,9 +257,16 @@ class DirectClient:
             return None
         return _safe_unpickle(local_path)
     
-    def store_file(self, path: str, basename: Union[str, None]=None):
+    def store_file(self, path: str, basename: Union[str, None]=None, *, return_mode: bool=False):
+        # If return_mode is True, returns (uri, mode) where mode is the method
+        # used to put the file into the storage (see _copy_file_into_storage),
+        # 'existing' if it was already stored, or 'daemon' if the daemon stored it
+        uri, mode = self._store_file(path, basename=basename)
+        return (uri, mode) if return_mode else uri
+
+    def _store_file(self, path: str, basename: Union[str, None]=None) -> Tuple[str, str]:
         if self._connected_to_daemon:
-            return store_file(path, basename=basename)
+            return store_file(path, basename=basename), 'daemon'
         if basename is None:
             basename = 'file.dat'
         sha1 = _compute_file_hash(path, algorithm='sha1')
@@ -164,11 +275,13 @@ class DirectClient:
         kachery_storage_parent_dir = f'{kachery_storage_dir}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}'
         kachery_storage_file_name = f'{kachery_storage_parent_dir}/{sha1}'
         if os.path.exists(kachery_storage_file_name):
-            return uri
+            _record_ephemeral_storage_access(sha1)
+            return uri, 'existing'
         if not os.path.exists(kachery_storage_parent_dir):
             os.makedirs(kachery_storage_parent_dir)
-        shutil.copyfile(path, kachery_storage_file_name)
-        return uri
+        mode = _copy_file_into_storage(path, kachery_storage_file_name)
+        _record_ephemeral_storage_access(sha1, added=True)
+        return uri, mode
     
     def store_text(self, text: str, basename: Union[str, None]=None):
         if self._channel is not None:
@@ -210,20 +323,178 @@ class DirectClient:
             _safe_pickle(fname, x)
             return self.store_file(fname, basename=basename)
 
-def _get_ephemeral_kachery_storage_dir():
-    from pathlib import Path
-    homedir = str(Path.home())
-    ksd = os.getenv('KACHERY_STORAGE_DIR', f'{homedir}/kachery-storage')
-    if not os.path.exists(ksd):
-        os.makedirs(ksd)
-    return ksd
-
 def _http_get_file(url, fname):
     from urllib import request
     request.urlretrieve(url, fname)
 
-def _concatenate_file_chunks(chunk_fnames: List[str], concat_fname: str):
-    with open(concat_fname, 'wb') as outf:
-        for fname in chunk_fnames:
-            with open(fname, 'rb') as f:
-                outf.write(f.read())
\ No newline at end of file
+def _http_get_range(url: str, start: int, end: int) -> Union[Tuple[bytes, int], None]:
+    # Get bytes [start, end) of a remote file using an HTTP Range request.
+    # Returns (bytes, total size of file), or None if the file was not found.
+    # Note that, unlike for whole files, the hash of the bytes cannot be verified.
+    from urllib import request
+    from urllib.error import HTTPError
+    req = request.Request(url)
+    req.add_header('Range', f'bytes={start}-{end - 1}')
+    try:
+        resp = request.urlopen(req)
+    except HTTPError as e:
+        if e.code in [403, 404]:
+            return None
+        raise
+    with resp:
+        if resp.status == 206:
+            # Content-Range: bytes <start>-<end>/<size>
+            content_range = resp.headers.get('Content-Range', '')
+            try:
+                total_size = int(content_range.split('/')[1])
+            except:
+                raise Exception(f'Unexpected Content-Range in response: {content_range}: {url}')
+            return resp.read(), total_size
+        else:
+            # the server ignored the range request
+            total_size = int(resp.headers['Content-Length'])
+            data = resp.read(end)
+            return data[start:end], total_size
+
+def _download_file(url: str, dest_fname: str, *, sha1: str) -> bool:
+    # Download a file, verifying the sha1 hash as the bytes stream in. The
+    # data is written to dest_fname + '.downloading' and renamed into place
+    # once verified. If the download is interrupted (e.g., the process is
+    # killed) the partial file is kept, and the next attempt resumes from
+    # where it left off using an HTTP Range request. The partial file is only
+    # used while holding an exclusive lock on it, so concurrent downloads of
+    # the same file (in other threads or processes) wait for each other.
+    # Returns False if the file could not be downloaded.
+    partial_fname = dest_fname + '.downloading'
+    with _download_lock(partial_fname) as locked:
+        if os.path.exists(dest_fname):
+            # downloaded by someone else while we were waiting
+            return True
+        if not locked:
+            # without locking we cannot safely share (and resume) the partial file
+            partial_fname = partial_fname + '.' + _random_string(6)
+        try:
+            return _download_to_partial_file(url, partial_fname, dest_fname, sha1=sha1)
+        finally:
+            if not locked and os.path.exists(partial_fname):
+                os.unlink(partial_fname)
+
+def _download_to_partial_file(url: str, partial_fname: str, dest_fname: str, *, sha1: str) -> bool:
+    from urllib import request
+    from urllib.error import HTTPError
+    hashsum = hashlib.sha1()
+    num_bytes_existing = 0
+    if os.path.exists(partial_fname):
+        # hash what we already have so we can continue hashing where we left off
+        with open(partial_fname, 'rb') as f:
+            while True:
+                buf = f.read(_DOWNLOAD_BLOCK_SIZE)
+                if len(buf) == 0:
+                    break
+                hashsum.update(buf)
+                num_bytes_existing += len(buf)
+    req = request.Request(url)
+    if num_bytes_existing > 0:
+        req.add_header('Range', f'bytes={num_bytes_existing}-')
+    try:
+        resp = request.urlopen(req)
+    except HTTPError as e:
+        if e.code == 416 and num_bytes_existing > 0:
+            # range not satisfiable: presumably we already have all of the bytes
+            resp = None
+        else:
+            return False
+    except:
+        return False
+    if resp is not None:
+        with resp:
+            if num_bytes_existing > 0 and resp.status != 206:
+                # the server ignored the range request, so we start over
+                print(f'Unable to resume download, starting over: {url}')
+                hashsum = hashlib.sha1()
+                mode = 'wb'
+            else:
+                mode = 'ab'
+            try:
+                with open(partial_fname, mode) as outf:
+                    while True:
+                        buf = resp.read(_DOWNLOAD_BLOCK_SIZE)
+                        if len(buf) == 0:
+                            break
+                        hashsum.update(buf)
+                        outf.write(buf)
+            except Exception as e:
+                print(f'Download interrupted (will resume on next attempt): {url}: {str(e)}')
+                return False
+    computed_sha1 = hashsum.hexdigest()
+    if computed_sha1 != sha1:
+        os.unlink(partial_fname)
+        raise Exception(f'Unexpected sha1 in downloaded file: {url}')
+    _rename_file(partial_fname, dest_fname, remove_if_exists=False)
+    if os.path.exists(partial_fname):
+        # the destination was created elsewhere in the meantime
+        os.unlink(partial_fname)
+    return True
+
+@contextmanager
+def _download_lock(path: str):
+    # Exclusive lock (between threads and processes) on path, held using
+    # fcntl.flock on path + '.lock'. Yields False if locking is not available
+    # on this platform (the caller must then not share files). The lock file
+    # is removed on release; since another process may have opened it before
+    # it was removed, we check after locking that we hold the lock on the file
+    # that is currently at that path, and retry otherwise.
+    try:
+        import fcntl
+    except ImportError:
+        yield False
+        return
+    lock_fname = path + '.lock'
+    while True:
+        fd = os.open(lock_fname, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                current = os.stat(lock_fname)
+            except FileNotFoundError:
+                current = None
+            if current is not None and os.path.samestat(current, os.fstat(fd)):
+                break
+        except:
+            os.close(fd)
+            raise
+        os.close(fd)
+    try:
+        yield True
+    finally:
+        os.unlink(lock_fname)
+        os.close(fd)
+
+_DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+def _assemble_file_from_chunks(chunk_fnames: List[str], dest_fname: str, *, sha1: str) -> None:
+    # Stream the chunks into a temporary file next to the destination, computing
+    # the sha1 as we go, and then atomically rename it into place. This way
+    # the chunks are read once, the output is written once, and memory use
+    # does not depend on the chunk size.
+    tmp_fname = dest_fname + '.assembling.' + _random_string(6)
+    hashsum = hashlib.sha1()
+    try:
+        with open(tmp_fname, 'wb') as outf:
+            for fname in chunk_fnames:
+                with open(fname, 'rb') as f:
+                    while True:
+                        buf = f.read(_ASSEMBLE_BLOCK_SIZE)
+                        if len(buf) == 0:
+                            break
+                        hashsum.update(buf)
+                        outf.write(buf)
+        computed_sha1 = hashsum.hexdigest()
+        if computed_sha1 != sha1:
+            raise Exception(f'Unexpected sha1 of concatenated file chunks: {computed_sha1} <> {sha1}')
+        _rename_file(tmp_fname, dest_fname, remove_if_exists=False)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+
+_ASSEMBLE_BLOCK_SIZE = 1024 * 1024
\ No newline at end of file
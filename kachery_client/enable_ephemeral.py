@@ -1,4 +1,4 @@
-from ._daemon_connection import _buffered_probe_daemon
+from ._daemon_connection import _buffered_probe_daemon, _offline_mode
 
 _global = {
     'ephemeral_enabled': False
@@ -11,4 +11,4 @@ def _ephemeral_enabled():
     return _global['ephemeral_enabled']
 
 def _use_ephemeral():
-    return _ephemeral_enabled() and (_buffered_probe_daemon() is None)
\ No newline at end of file
+    return _ephemeral_enabled() and (not _offline_mode()) and (_buffered_probe_daemon() is None)
\ No newline at end of file
@@ -1,13 +1,12 @@
 import os
 import base64
-from typing import Union, Any
-import shutil
+from typing import List, Union, Any
 import numpy as np
-from ..direct_client.DirectClient import _get_ephemeral_kachery_storage_dir
+from .._ephemeral_storage_manager import _get_ephemeral_kachery_storage_dir, _record_ephemeral_storage_access
 from .._misc import _http_post_json, _parse_kachery_uri, _get_kachery_hub_uri
-from .._temporarydirectory import TemporaryDirectory
-from ..direct_client.DirectClient import _concatenate_file_chunks, _http_get_file
-from .._local_kachery_storage import _compute_file_hash
+from ..direct_client.DirectClient import _assemble_file_from_chunks, _download_file, _http_get_range
+from .._local_kachery_storage import _load_bytes_from_local_file
+from .._sparse_file_cache import _get_sparse_file_cache
 
 
 _global = {
@@ -92,6 +91,7 @@ def ephemeral_load_file(uri: str, *, local_only: bool=False, channel: Union[str,
     kachery_storage_file_name = f'{kachery_storage_parent_dir}/{sha1}'
     if os.path.exists(kachery_storage_file_name):
         # we have the file locally... return that
+        _record_ephemeral_storage_access(sha1)
         return kachery_storage_file_name
     if 'manifest' in query:
         # The uri has a manifest. But let's first check whether the file is stored on the bucket in its entirety
@@ -110,25 +110,77 @@ def ephemeral_load_file(uri: str, *, local_only: bool=False, channel: Union[str,
             if chunk_fname is None:
                 return None
             chunk_files.append(chunk_fname)
-        # we need to stitch the file together
-        with TemporaryDirectory() as tmpdir:
-            tmp_fname = f'{tmpdir}/concat.dat'
-            _concatenate_file_chunks(chunk_files, tmp_fname)
-            computed_sha1 = _compute_file_hash(tmp_fname, algorithm='sha1')
-            if computed_sha1 != sha1:
-                raise Exception(f'Unexpected sha1 of concatenated file for {uri}')
-            if not os.path.exists(kachery_storage_parent_dir):
-                os.makedirs(kachery_storage_parent_dir)
-            shutil.copyfile(tmp_fname, kachery_storage_file_name)
-            return kachery_storage_file_name
+        # we need to stitch the file together (streaming directly into the local kachery storage)
+        if not os.path.exists(kachery_storage_parent_dir):
+            os.makedirs(kachery_storage_parent_dir)
+        _assemble_file_from_chunks(chunk_files, kachery_storage_file_name, sha1=sha1)
+        _record_ephemeral_storage_access(sha1, added=True)
+        return kachery_storage_file_name
     bb = _load_direct_from_channel_buckets(sha1, channel=channel)
     if bb is not None:
         return bb
     return None
 
-def _ephemeral_load_json(uri: str) -> Union[None, dict, list, int, float]:
+def ephemeral_load_bytes(uri: str, start: Union[int, None], end: Union[int, None], *, local_only: bool=False, channel: Union[str, None]=None) -> Union[bytes, None]:
+    # Load a byte range of a file without downloading the whole file (or whole
+    # manifest chunks). Only the blocks that are not already in the sparse
+    # file cache are fetched from the channel buckets using HTTP Range requests.
+    protocol, algorithm, sha1, additional_path, query = _parse_kachery_uri(uri)
+    assert algorithm == 'sha1'
+    if 'manifest' in query:
+        manifest = _ephemeral_load_json(f'sha1://{query["manifest"][0]}', channel=channel)
+        if manifest is None:
+            return None
+        assert manifest['sha1'] == sha1, 'Manifest sha1 does not match expected.'
+        if start is None:
+            start = 0
+        if end is None:
+            end = manifest['size']
+        # first check whether the file is available in its entirety
+        data = _ephemeral_load_bytes_of_object(sha1, start=start, end=end, size=manifest['size'], local_only=local_only, channel=channel)
+        if data is not None:
+            return data
+        parts: List[bytes] = []
+        for ch in manifest['chunks']:
+            if start < ch['end'] and end > ch['start']:
+                part = _ephemeral_load_bytes_of_object(ch['sha1'], start=max(start, ch['start']) - ch['start'], end=min(end, ch['end']) - ch['start'], size=ch['end'] - ch['start'], local_only=local_only, channel=channel)
+                if part is None:
+                    return None
+                parts.append(part)
+        return b''.join(parts)
+    if start is None or end is None:
+        # we need the size of the file, so we load the whole thing
+        local_path = ephemeral_load_file(uri, local_only=local_only, channel=channel)
+        if local_path is None:
+            return None
+        return _load_bytes_from_local_file(local_path, start=start, end=end)
+    return _ephemeral_load_bytes_of_object(sha1, start=start, end=end, size=None, local_only=local_only, channel=channel)
+
+def _ephemeral_load_bytes_of_object(sha1: str, *, start: int, end: int, size: Union[int, None], local_only: bool, channel: Union[str, None]) -> Union[bytes, None]:
+    kachery_storage_dir = _get_ephemeral_kachery_storage_dir()
+    kachery_storage_file_name = f'{kachery_storage_dir}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
+    if os.path.exists(kachery_storage_file_name):
+        _record_ephemeral_storage_access(sha1)
+        return _load_bytes_from_local_file(kachery_storage_file_name, start=start, end=end)
+    sparse_file_cache = _get_sparse_file_cache()
+    # the blocks may already be cached
+    data = sparse_file_cache.read(sha1, start=start, end=end, size=size, fetch=None)
+    if data is not None or local_only:
+        return data
+    node_config = _get_node_config()
+    for ch in node_config['channelMemberships']:
+        channel_name = ch['channelName']
+        if channel is None or channel == channel_name:
+            channel_bucket_base_url = ch['channelBucketBaseUrl']
+            file_url = f'{channel_bucket_base_url}/{channel_name}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
+            data = sparse_file_cache.read(sha1, start=start, end=end, size=size, fetch=lambda a, b: _http_get_range(file_url, a, b))
+            if data is not None:
+                return data
+    return None
+
+def _ephemeral_load_json(uri: str, *, channel: Union[str, None]=None) -> Union[None, dict, list, int, float]:
     import simplejson
-    local_path = ephemeral_load_file(uri)
+    local_path = ephemeral_load_file(uri, channel=channel)
     if local_path is None:
         return None
     with open(local_path, 'r') as f:
@@ -139,23 +191,21 @@ def _load_direct_from_channel_buckets(sha1: str, *, channel: Union[str, None]=No
     kachery_storage_dir = _get_ephemeral_kachery_storage_dir()
     kachery_storage_parent_dir = f'{kachery_storage_dir}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}'
     kachery_storage_file_name = f'{kachery_storage_parent_dir}/{sha1}'
-    with TemporaryDirectory() as tmpdir:
-        tmp_fname = f'{tmpdir}/file.dat'
-        for ch in node_config['channelMemberships']:
-            channel_name = ch['channelName']
-            if channel is None or channel == channel_name:
-                channel_bucket_base_url = ch['channelBucketBaseUrl']
-                file_url = f'{channel_bucket_base_url}/{channel_name}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
-                try:
-                    _http_get_file(file_url, tmp_fname)
-                    downloaded = True
-                except:
-                    downloaded = False
-                if downloaded:
-                    if not os.path.exists(kachery_storage_parent_dir):
-                        os.makedirs(kachery_storage_parent_dir)
-                    shutil.copyfile(tmp_fname, kachery_storage_file_name)
-                    return kachery_storage_file_name
+    for ch in node_config['channelMemberships']:
+        channel_name = ch['channelName']
+        if channel is None or channel == channel_name:
+            channel_bucket_base_url = ch['channelBucketBaseUrl']
+            file_url = f'{channel_bucket_base_url}/{channel_name}/sha1/{sha1[0]}{sha1[1]}/{sha1[2]}{sha1[3]}/{sha1[4]}{sha1[5]}/{sha1}'
+            # download directly into the ephemeral local kachery storage (the hash is verified as the bytes stream in)
+            os.makedirs(kachery_storage_parent_dir, exist_ok=True)
+            try:
+                downloaded = _download_file(file_url, kachery_storage_file_name, sha1=sha1)
+            except Exception as e:
+                print(f'WARNING: problem downloading file from channel bucket: {file_url}: {str(e)}')
+                downloaded = False
+            if downloaded:
+                _record_ephemeral_storage_access(sha1, added=True)
+                return kachery_storage_file_name
     return None
 
 ed25519PubKeyPrefix = "302a300506032b6570032100"
@@ -0,0 +1,182 @@
+import copy
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Tuple, Union
+from ._safe_pickle import _is_numpy_array
+
+# Opt-in in-process cache of the parsed results of load_json, load_text,
+# load_npy and load_pkl. Since the content of a sha1:// URI never changes,
+# the parsed object can be reused for as long as it is not modified, so
+# cached objects are either returned as read-only (frozen) objects or
+# copied on each return.
+
+_global = {
+    'enabled': False,
+    'max_bytes': 256 * 1024 * 1024,
+    'return_mode': 'frozen'
+}
+
+_cache: 'OrderedDict[Tuple[str, str], Tuple[Any, int]]' = OrderedDict()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'num_bytes': 0
+}
+_lock = threading.Lock()
+
+def enable_load_cache(enabled: bool=True, *, max_bytes: int=256 * 1024 * 1024, return_mode: str='frozen'):
+    """Enable (or disable) the in-process cache of parsed load_json, load_text, load_npy and load_pkl results
+
+    Args:
+        enabled (bool, optional): Whether to enable the cache. Defaults to True.
+        max_bytes (int, optional): The budget for the cache, measured by the size of the loaded files. Defaults to 256 MiB.
+        return_mode (str, optional): 'frozen' to return read-only objects (dicts and lists that cannot be modified, read-only Numpy arrays), or 'copy' to return a copy on each load. Defaults to 'frozen'.
+    """
+    if return_mode not in ['frozen', 'copy']:
+        raise Exception(f'Unexpected return_mode for load cache: {return_mode}')
+    with _lock:
+        if return_mode != _global['return_mode']:
+            # the cached objects are stored according to the return mode
+            _clear()
+        _global['enabled'] = enabled
+        _global['max_bytes'] = max_bytes
+        _global['return_mode'] = return_mode
+        if not enabled:
+            _clear()
+        _evict_if_needed()
+
+def get_load_cache_stats() -> dict:
+    """Return the hit, miss and eviction counts and the current size of the load cache"""
+    with _lock:
+        return {
+            'enabled': _global['enabled'],
+            'hits': _stats['hits'],
+            'misses': _stats['misses'],
+            'evictions': _stats['evictions'],
+            'num_items': len(_cache),
+            'num_bytes': _stats['num_bytes'],
+            'max_bytes': _global['max_bytes']
+        }
+
+def clear_load_cache():
+    """Remove all items from the load cache"""
+    with _lock:
+        _clear()
+
+def _load_cache_enabled() -> bool:
+    return _global['enabled']
+
+def _load_with_cache(kind: str, sha1: str, load: Callable[[], Union[Tuple[Any, int], None]]) -> Any:
+    # load() returns (parsed object, size of file in bytes) or None if not found
+    key = (kind, sha1)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            _stats['hits'] += 1
+            cached = _cache[key]
+        else:
+            cached = None
+            _stats['misses'] += 1
+    if cached is not None:
+        # copied (if needed) outside the lock so that other loads are not blocked
+        return _return_cached(cached[0])
+    a = load()
+    if a is None:
+        return None
+    x, size = a
+    if _global['return_mode'] == 'frozen':
+        x = _freeze(x)
+    if size <= _global['max_bytes']:
+        with _lock:
+            if key not in _cache:
+                _cache[key] = (x, size)
+                _stats['num_bytes'] += size
+                _evict_if_needed()
+    return _return_cached(x)
+
+def _return_cached(x: Any) -> Any:
+    if _global['return_mode'] == 'copy':
+        return copy.deepcopy(x)
+    return x
+
+def _clear():
+    _cache.clear()
+    _stats['num_bytes'] = 0
+
+def _evict_if_needed():
+    # least recently used items are first
+    while _stats['num_bytes'] > _global['max_bytes'] and len(_cache) > 0:
+        key, (x, size) = _cache.popitem(last=False)
+        _stats['num_bytes'] -= size
+        _stats['evictions'] += 1
+
+def _read_only_error(*args, **kwargs):
+    raise TypeError('This object is read-only because it is shared by the kachery_client load cache. Make a copy to modify it.')
+
+class _FrozenDict(dict):
+    __setitem__ = _read_only_error
+    __delitem__ = _read_only_error
+    __ior__ = _read_only_error
+    clear = _read_only_error
+    pop = _read_only_error
+    popitem = _read_only_error
+    setdefault = _read_only_error
+    update = _read_only_error
+    # copies (and unpickled objects) are plain, modifiable dicts
+    def __copy__(self):
+        return _unfreeze(self)
+    def __deepcopy__(self, memo):
+        return _unfreeze(self, memo=memo)
+    def __reduce__(self):
+        return (dict, (_unfreeze(self),))
+
+class _FrozenList(list):
+    __setitem__ = _read_only_error
+    __delitem__ = _read_only_error
+    __iadd__ = _read_only_error
+    __imul__ = _read_only_error
+    append = _read_only_error
+    extend = _read_only_error
+    insert = _read_only_error
+    remove = _read_only_error
+    pop = _read_only_error
+    clear = _read_only_error
+    sort = _read_only_error
+    reverse = _read_only_error
+    # copies (and unpickled objects) are plain, modifiable lists
+    def __copy__(self):
+        return _unfreeze(self)
+    def __deepcopy__(self, memo):
+        return _unfreeze(self, memo=memo)
+    def __reduce__(self):
+        return (list, (_unfreeze(self),))
+
+def _unfreeze(x: Any, *, memo: Union[dict, None]=None) -> Any:
+    # the inverse of _freeze, used when copying; with memo (deepcopy), the
+    # other (e.g., numpy) values are deep-copied as well
+    if isinstance(x, dict):
+        return {k: _unfreeze(v, memo=memo) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_unfreeze(a, memo=memo) for a in x]
+    elif isinstance(x, tuple):
+        return tuple([_unfreeze(a, memo=memo) for a in x])
+    elif memo is not None:
+        return copy.deepcopy(x, memo)
+    else:
+        return x
+
+def _freeze(x: Any) -> Any:
+    if isinstance(x, dict):
+        return _FrozenDict({k: _freeze(v) for k, v in x.items()})
+    elif isinstance(x, list):
+        return _FrozenList([_freeze(a) for a in x])
+    elif isinstance(x, tuple):
+        return tuple([_freeze(a) for a in x])
+    elif isinstance(x, set):
+        return frozenset(x)
+    elif _is_numpy_array(x):
+        x.setflags(write=False)
+        return x
+    else:
+        return x
@@ -0,0 +1,186 @@
+import os
+import threading
+from typing import Dict, Iterable, Tuple, Union
+from ._daemon_connection import _kachery_storage_dir
+
+# Optional in-memory index of the {storage}/sha1/aa/bb/cc/ tree, so that
+# existence checks in the local kachery storage do not require several file
+# system calls per lookup (which is slow on network file systems).
+#
+# The index is sharded by the first two characters of the hash (the top-level
+# directory), and each shard is built by scanning its directory in a
+# background thread the first time it is needed. Scanning a shard can take
+# thousands of directory listings, so lookups do not wait for it: until the
+# shard has been scanned, lookups in it are misses. Files stored or linked by
+# this process are added as they are stored. Files added by other processes
+# (e.g., the daemon) are not known to the index, so a miss falls back to
+# checking the file system.
+
+_global = {
+    'enabled': False
+}
+
+def enable_local_storage_index(enabled: bool=True):
+    """Enable (or disable) the in-memory index of the local kachery storage
+
+    When enabled, files that are known to be in the local kachery storage are
+    found without checking the file system. Files that are removed from the
+    storage by other means than kachery_client may still be reported as
+    present (load_bytes detects this) until clear_local_storage_index() is
+    called.
+
+    Args:
+        enabled (bool, optional): Whether to enable the index. Defaults to True.
+    """
+    _global['enabled'] = enabled
+    if not enabled:
+        clear_local_storage_index()
+
+def clear_local_storage_index():
+    """Discard the in-memory index of the local kachery storage. It will be rebuilt as needed."""
+    with _indexes_lock:
+        _indexes.clear()
+
+class _LocalStorageIndex:
+    def __init__(self, storage_dir: str):
+        self._sha1_directory = f'{storage_dir}/sha1'
+        self._lock = threading.Lock()
+        # shard (first two characters of hash) -> {hash: is_link}
+        self._shards: Dict[str, Dict[str, bool]] = {}
+        # Shards are scanned in background threads, without holding
+        # self._lock (scanning can be slow on network file systems). Changes
+        # made to a shard during its scan are applied afterwards.
+        self._changes_during_scan: Dict[str, Dict[str, Union[bool, None]]] = {}
+    def lookup(self, sha1: str) -> Union[Tuple[str, bool], None]:
+        # returns (path, is_link) where path is the path of the .link file if is_link
+        shard = self._get_shard(sha1[0:2])
+        if shard is None:
+            return None
+        with self._lock:
+            is_link = shard.get(sha1, None)
+        if is_link is None:
+            return None
+        return self._path(sha1, is_link), is_link
+    def lookup_many(self, sha1s: Iterable[str]) -> Dict[str, Union[Tuple[str, bool], None]]:
+        sha1s = list(sha1s)
+        shards = {prefix: self._get_shard(prefix) for prefix in set([sha1[0:2] for sha1 in sha1s])}
+        ret: Dict[str, Union[Tuple[str, bool], None]] = {}
+        with self._lock:
+            for sha1 in sha1s:
+                shard = shards[sha1[0:2]]
+                is_link = shard.get(sha1, None) if shard is not None else None
+                ret[sha1] = (self._path(sha1, is_link), is_link) if is_link is not None else None
+        return ret
+    def add(self, sha1: str, *, is_link: bool):
+        with self._lock:
+            changes = self._changes_during_scan.get(sha1[0:2], None)
+            if changes is not None:
+                if changes.get(sha1, None) is not False:
+                    changes[sha1] = is_link
+                return
+            shard = self._shards.get(sha1[0:2], None)
+            if shard is None:
+                # the file will be found when the shard is scanned
+                return
+            if shard.get(sha1, None) is False:
+                # a stored file takes precedence over a link
+                return
+            shard[sha1] = is_link
+    def remove(self, sha1: str):
+        with self._lock:
+            changes = self._changes_during_scan.get(sha1[0:2], None)
+            if changes is not None:
+                changes[sha1] = None
+            shard = self._shards.get(sha1[0:2], None)
+            if shard is not None and sha1 in shard:
+                del shard[sha1]
+    def _path(self, sha1: str, is_link: bool):
+        path = os.path.join(self._sha1_directory, sha1[0:2], sha1[2:4], sha1[4:6], sha1)
+        return path + '.link' if is_link else path
+    def _get_shard(self, prefix: str) -> Union[Dict[str, bool], None]:
+        # returns None (and starts scanning the shard) if the shard has not
+        # been scanned yet
+        with self._lock:
+            shard = self._shards.get(prefix, None)
+            if shard is not None or prefix in self._changes_during_scan:
+                return shard
+            self._changes_during_scan[prefix] = {}
+        threading.Thread(target=self._scan, args=(prefix,), daemon=True).start()
+        return None
+    def _scan(self, prefix: str):
+        try:
+            shard = _scan_shard(f'{self._sha1_directory}/{prefix}')
+        except Exception as e:
+            print(f'WARNING: problem scanning local kachery storage index shard {prefix}: {str(e)}')
+            shard = None
+        with self._lock:
+            changes = self._changes_during_scan.pop(prefix)
+            if shard is None:
+                # the shard will be scanned again on the next lookup
+                return
+            for sha1, is_link in changes.items():
+                if is_link is None:
+                    shard.pop(sha1, None)
+                elif shard.get(sha1, None) is not False:
+                    shard[sha1] = is_link
+            self._shards[prefix] = shard
+
+def _scan_shard(shard_dir: str) -> Dict[str, bool]:
+    shard: Dict[str, bool] = {}
+    for dir1 in _list_subdirs(shard_dir):
+        for dir2 in _list_subdirs(dir1):
+            try:
+                entries = list(os.scandir(dir2))
+            except OSError:
+                continue
+            for e in entries:
+                # skip temporary files (e.g., *.copying.*, *.link.*)
+                if len(e.name) == 40:
+                    shard[e.name] = False
+                elif len(e.name) == 45 and e.name.endswith('.link'):
+                    shard.setdefault(e.name[:40], True)
+    return shard
+
+def _list_subdirs(dirpath: str):
+    try:
+        return [e.path for e in os.scandir(dirpath) if e.is_dir()]
+    except OSError:
+        return []
+
+_indexes: Dict[str, _LocalStorageIndex] = {}
+_indexes_lock = threading.Lock()
+
+def _get_local_storage_index() -> Union[_LocalStorageIndex, None]:
+    if not _global['enabled']:
+        return None
+    ksd = _kachery_storage_dir()
+    if ksd is None:
+        return None
+    with _indexes_lock:
+        index = _indexes.get(ksd, None)
+        if index is None:
+            index = _LocalStorageIndex(ksd)
+            _indexes[ksd] = index
+    return index
+
+def _local_storage_index_lookup(sha1: str) -> Union[Tuple[str, bool], None]:
+    index = _get_local_storage_index()
+    if index is None:
+        return None
+    return index.lookup(sha1)
+
+def _local_storage_index_lookup_many(sha1s: Iterable[str]) -> Dict[str, Union[Tuple[str, bool], None]]:
+    index = _get_local_storage_index()
+    if index is None:
+        return {sha1: None for sha1 in sha1s}
+    return index.lookup_many(sha1s)
+
+def _add_to_local_storage_index(sha1: str, *, is_link: bool):
+    index = _get_local_storage_index()
+    if index is not None:
+        index.add(sha1, is_link=is_link)
+
+def _remove_from_local_storage_index(sha1: str):
+    index = _get_local_storage_index()
+    if index is not None:
+        index.remove(sha1)
@@ -6,9 +6,12 @@ from ._feeds import (_create_feed, _delete_feed, _get_feed_id, _load_feed,
                      _load_subfeed, _watch_for_new_messages)
 from ._mutables import (_get, _set, _delete)
 
-from ._load_file import _load_file, _load_bytes, _load_text, _load_json, _load_npy, _load_pkl
-from ._store_file import _store_file, _store_text, _store_json, _store_npy, _store_pkl, _link_file
-from ._daemon_connection import _get_node_id
+from ._load_file import _load_file, _load_files, _load_bytes, _load_buffer, _load_text, _load_json, _load_npy, _load_pkl
+from ._store_file import _store_file, _store_files, _store_text, _store_json, _store_npy, _store_pkl, _link_file
+from ._daemon_connection import _get_node_id, _set_kachery_offline_storage_dir
+from ._local_kachery_storage import _find_stale_links
+from ._ephemeral_storage_manager import _gc_ephemeral_storage, _set_ephemeral_storage_pinned
+from ._misc import _parse_kachery_uri
 from ._uri_handling import KacheryUri, _build_uri, _parse_uri
 
 def load_file(
@@ -29,18 +32,58 @@ def load_file(
     """
     return _load_file(uri=uri, dest=dest, local_only=local_only, channel=channel)
 
-def load_bytes(uri: str, start: int, end: int, *, write_to_stdout=False, channel: Union[str, None]=None) -> Union[bytes, None]:
+def load_files(
+    uris: List[str],
+    *,
+    local_only: bool=False,
+    channel: Union[str, None]=None,
+    max_concurrency: int=4
+) -> Dict[str, Union[str, None]]:
+    """Load a batch of files either from local kachery storage or from a remote kachery node
+
+    URIs referring to the same file are only loaded once, files found in the local
+    kachery storage are resolved in a single pass, and the remaining files are
+    downloaded concurrently. A failure to load one file does not affect the others.
+
+    Args:
+        uris (List[str]): The kachery URIs for the files to load: sha1://...
+        local_only (bool, optional): Optionally only load files from local kachery directory. Defaults to False.
+        channel (Union[str, None], optional): The kachery channel to download from. Defaults to None.
+        max_concurrency (int, optional): Maximum number of files to download in parallel. Defaults to 4.
+
+    Returns:
+        Dict[str, Union[str, None]]: Map from each URI to the local path of the loaded file, or None if the file could not be loaded
+    """
+    return _load_files(uris=uris, local_only=local_only, channel=channel, max_concurrency=max_concurrency)
+
+def load_bytes(uri: str, start: int, end: int, *, write_to_stdout=False, channel: Union[str, None]=None, max_concurrency: int=4) -> Union[bytes, None]:
     """Load a subset of bytes from a file in local storage or from remote nodes in the kachery network
 
     Args:
         uri (str): The kachery URI for the file to load: sha1://...
         start (int): The start byte (inclusive)
         end (int): The end byte (not inclusive)
+        max_concurrency (int, optional): Maximum number of manifest chunks to download in parallel. Defaults to 4.
 
     Returns:
         Union[bytes, None]: The bytes if found, else None
     """
-    return _load_bytes(uri=uri, start=start, end=end, write_to_stdout=write_to_stdout, channel=channel)
+    return _load_bytes(uri=uri, start=start, end=end, write_to_stdout=write_to_stdout, channel=channel, max_concurrency=max_concurrency)
+
+def load_buffer(uri: str, start: Union[int, None]=None, end: Union[int, None]=None, *, channel: Union[str, None]=None) -> Union[memoryview, None]:
+    """Load a read-only, zero-copy view of a file (or a subset of its bytes) by memory-mapping the file in local kachery storage
+
+    The file is first loaded from local storage or from remote nodes in the kachery network, as in load_file
+
+    Args:
+        uri (str): The kachery URI for the file to load: sha1://...
+        start (Union[int, None], optional): The start byte (inclusive). Defaults to None (beginning of file).
+        end (Union[int, None], optional): The end byte (not inclusive). Defaults to None (end of file).
+
+    Returns:
+        Union[memoryview, None]: The read-only memoryview if found, else None
+    """
+    return _load_buffer(uri=uri, start=start, end=end, channel=channel)
 
 def load_json(uri: str, *, channel: Union[str, None]=None) -> Union[dict, None]:
     """Load an object (Python dict) either from local kachery storage or from a remote kachery node
@@ -64,16 +107,17 @@ def load_text(uri: str, *, channel: Union[str, None]=None) -> Union[str, None]:
     """
     return _load_text(uri=uri, channel=channel)
 
-def load_npy(uri: str, *, channel: Union[str, None]=None) -> Union[np.ndarray, None]:
+def load_npy(uri: str, *, channel: Union[str, None]=None, mmap_mode: Union[str, None]=None) -> Union[np.ndarray, None]:
     """Load a Numpy array either from local kachery storage or from a remote kachery node
 
     Args:
         uri (str): The kachery URI for the .npy file to load: sha1://...
+        mmap_mode (Union[str, None], optional): Optionally memory-map the file rather than reading it into memory ('r' for read-only or 'c' for copy-on-write). Defaults to None.
 
     Returns:
         Union[str, None]: If found, the Numpy array, else None
     """
-    return _load_npy(uri=uri, channel=channel)
+    return _load_npy(uri=uri, channel=channel, mmap_mode=mmap_mode)
 
 def load_pkl(uri: str, *, channel: Union[str, None]=None) -> Union[Any, None]:
     """Load a Python item from a restricted pickle format either from local kachery storage or from a remote kachery node
@@ -98,6 +142,21 @@ def store_file(path: str, basename: Union[str, None]=None) -> str:
     """
     return _store_file(path=path, basename=basename)
 
+def store_files(paths: List[str], *, max_concurrency: int=4) -> List[str]:
+    """Store a batch of files in the local kachery storage and return the kachery URIs
+
+    The files are hashed using a pool of workers, and files that are already in the
+    local kachery storage are not sent to the daemon again.
+
+    Args:
+        paths (List[str]): Paths of the files to store
+        max_concurrency (int, optional): Maximum number of files to hash or store in parallel. Defaults to 4.
+
+    Returns:
+        List[str]: The kachery URIs (sha1://...), in the same order as the paths
+    """
+    return _store_files(paths=paths, max_concurrency=max_concurrency)
+
 def link_file(path: str, basename: Union[str, None]=None) -> str:
     """Link a local file in the local kachery storage (will therefore be available on the kachery network) and return a kachery URI
 
@@ -110,6 +169,22 @@ def link_file(path: str, basename: Union[str, None]=None) -> str:
     """
     return _link_file(path=path, basename=basename)
 
+def find_stale_links(*, max_concurrency: int=8) -> List[dict]:
+    """Check all links in the local kachery storage (created by link_file) and return those that are no longer valid
+
+    The linked files are checked in parallel. This can take a while for large
+    storage directories on network file systems, so it is intended to be run
+    in the background (for example, in a separate thread or using the
+    find-stale-links command of the command-line client).
+
+    Args:
+        max_concurrency (int, optional): Number of links to check in parallel. Defaults to 8.
+
+    Returns:
+        List[dict]: A list of {link_path, path, problem} for the stale links
+    """
+    return _find_stale_links(max_concurrency=max_concurrency)
+
 def store_json(object: Union[dict, list, int, float, str], basename: Union[str, None]=None) -> str:
     """Store object (Python dict, list or other jsonable) in the local kachery storage (will therefore be available on the kachery network) and return a kachery URI
 
@@ -171,6 +246,20 @@ def get_node_id(daemon_port=None) -> str:
 
 ################################################
 
+def set_offline_storage_dir(storage_dir: Union[str, None]) -> None:
+    """Use a kachery storage directory directly, without a daemon (offline mode)
+
+    In offline mode, load_file, load_bytes, load_npy, etc. resolve files from
+    the given storage directory only (for example, a directory shared over
+    NFS) and never contact the daemon. Files that are not found are reported
+    as None. Equivalent to setting the KACHERY_OFFLINE_STORAGE_DIR environment
+    variable.
+
+    Args:
+        storage_dir (Union[str, None]): The kachery storage directory, or None to leave offline mode (unless KACHERY_OFFLINE_STORAGE_DIR is set)
+    """
+    _set_kachery_offline_storage_dir(storage_dir)
+
 def create_feed(feed_name: Union[str, None]=None):
     """Create a new local feed and optionally associate it with a local name
 
@@ -214,18 +303,19 @@ def load_subfeed(subfeed_uri: str, *, channel: str='*local*'):
     """
     return _load_subfeed(subfeed_uri=subfeed_uri, channel=channel)
         
-def load_feed(feed_name_or_uri: str, *, timeout_sec: Union[None, float]=None, create=False):
+def load_feed(feed_name_or_uri: str, *, timeout_sec: Union[None, float]=None, create=False, channel: Union[str, None]=None):
     """Load a feed by URI or local name
 
     Args:
         feed_name_or_uri (str): Either the local name or the URI of the feed to load
         timeout_sec (Union[None, float], optional): An optional timeout for searching for the feed. Defaults to None.
         create (bool, optional): Whether to create if doesn't exist (only applies when supplying a local feed name). Defaults to False.
+        channel (Union[str, None], optional): For a snapshot (sha1:// URI), the kachery channel to load its segments from. Without a channel, the segments must be in the local kachery storage. Defaults to None.
 
     Returns:
         Feed: The loaded feed
     """
-    return _load_feed(feed_name_or_uri=feed_name_or_uri, timeout_sec=timeout_sec, create=create)
+    return _load_feed(feed_name_or_uri=feed_name_or_uri, timeout_sec=timeout_sec, create=create, channel=channel)
 
 def watch_for_new_messages(subfeed_watches: Dict[str, dict], *, wait_msec, channel: str='*local*', signed=False) -> Dict[str, Any]:
     """Watch for new messages on one or more subfeeds
@@ -312,3 +402,46 @@ def build_uri(uri_object: KacheryUri):
         str: A usable URI string.
     """    
     return _build_uri(uri_object=uri_object)
+
+def gc_ephemeral_storage(*, max_size_gb: Union[float, None]=None, policy: Union[str, None]=None, dry_run: bool=False) -> dict:
+    """Evict files from the ephemeral kachery storage (used in ephemeral mode and by DirectClient) to keep it under a maximum size
+
+    Only files that were downloaded or stored by kachery_client are evicted
+    (never files that were already in the directory), in least-recently-used
+    ('lru') or least-frequently-used ('lfu') order. Pinned files and files
+    accessed within the last few minutes are never evicted. Raises an
+    exception if the directory belongs to a kachery daemon. When KACHERY_EPHEMERAL_STORAGE_QUOTA_GB is set,
+    this happens automatically as files are added.
+
+    Args:
+        max_size_gb (Union[float, None], optional): The maximum size of the storage in GB. Defaults to KACHERY_EPHEMERAL_STORAGE_QUOTA_GB.
+        policy (Union[str, None], optional): 'lru' or 'lfu'. Defaults to KACHERY_EPHEMERAL_STORAGE_EVICTION_POLICY, or 'lru'.
+        dry_run (bool, optional): Only report what would be evicted. Defaults to False.
+
+    Returns:
+        dict: {num_files_evicted, num_bytes_evicted, num_bytes_remaining}
+    """
+    max_bytes = int(max_size_gb * 1e9) if max_size_gb is not None else None
+    return _gc_ephemeral_storage(max_bytes=max_bytes, policy=policy, dry_run=dry_run)
+
+def pin_file(uri: str) -> None:
+    """Prevent a file from being evicted from the ephemeral kachery storage
+
+    Args:
+        uri (str): The kachery URI of the file: sha1://...
+    """
+    _set_ephemeral_storage_pinned(_sha1_of_uri(uri), True)
+
+def unpin_file(uri: str) -> None:
+    """Allow a file that was pinned using pin_file to be evicted from the ephemeral kachery storage again
+
+    Args:
+        uri (str): The kachery URI of the file: sha1://...
+    """
+    _set_ephemeral_storage_pinned(_sha1_of_uri(uri), False)
+
+def _sha1_of_uri(uri: str) -> str:
+    protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+    if protocol != 'sha1':
+        raise Exception(f'Expected a sha1:// URI: {uri}')
+    return hash0
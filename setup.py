@@ -19,5 +19,8 @@ setuptools.setup(
         "requests",
         'cryptography',
         "jinjaroot"
-    ]
+    ],
+    extras_require={
+        "aio": ["aiohttp"]
+    }
 )